@@ -7,7 +7,8 @@
 """
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+
+from acmewines.routing import RoutingSQLAlchemy
 
 # Initialize the app
 app = Flask(__name__)
@@ -15,14 +16,24 @@ app = Flask(__name__)
 # Configure the app
 app.config.from_object('config')
 
-# Initialize a SQLAlchemy object and integrate it to the app
-db = SQLAlchemy(app)
+# Initialize a SQLAlchemy object and integrate it to the app, with the
+# read-only queries routed to the replicas
+db = RoutingSQLAlchemy(app)
+
+# Time the requests and their SQL
+from acmewines import instrumentation
+instrumentation.init_app(app)
+
+# Limit the concurrent requests and the duration of the order queries
+from acmewines import admission
+admission.init_app(app)
 
 @app.errorhandler(404)
 def page_not_found(error):
     return 'This page does not exist', 404
 
-from acmewines.views import orders
+from acmewines.views import orders, tasks
 app.register_blueprint(orders.mod)
+app.register_blueprint(tasks.mod)
 
 
@@ -0,0 +1,143 @@
+"""
+    acmewines.admission
+    ~~~~~~~~~~~~~~~~~~~
+
+    This module protects the database under overload: it caps the
+    concurrent requests per route, queues a bounded number of requests
+    beyond the cap and turns the others away with a 503, and cancels the
+    order queries running past their statement timeout
+"""
+
+import threading
+import time
+
+from flask import g, jsonify, request
+from sqlalchemy.exc import OperationalError
+
+from acmewines import db
+
+# The SQLSTATE of the PostgreSQL statements cancelled by a timeout
+QUERY_CANCELED = '57014'
+
+
+class RouteLimiter(object):
+    """ Admit up to limit concurrent requests, and let up to queue_size
+    more wait at most queue_timeout seconds for a slot.
+    """
+
+    def __init__(self, limit, queue_size=0, queue_timeout=0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue when there is room in it.
+        Return False when the request has to be turned away.
+        """
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.queue_timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class AdmissionController(object):
+    """ Keep the limiters of the routes (endpoints) with a limit. """
+
+    def __init__(self, limits=None, default_limit=None, queue_size=0,
+        queue_timeout=0, retry_after=1):
+        self.retry_after = retry_after
+        self._limiters = {}
+        for endpoint, limit in (limits or {}).items():
+            self._limiters[endpoint] = RouteLimiter(limit, queue_size,
+                queue_timeout)
+        self._default_limiter = RouteLimiter(default_limit, queue_size,
+            queue_timeout) if default_limit else None
+
+    def limiter(self, endpoint):
+        return self._limiters.get(endpoint, self._default_limiter)
+
+    def limiters(self):
+        """Get the (endpoint, limiter) pairs, with a None endpoint for the
+        default limiter.
+        """
+        limiters = sorted(self._limiters.items())
+        if self._default_limiter is not None:
+            limiters.append((None, self._default_limiter))
+        return limiters
+
+
+def _unavailable(message, retry_after):
+    response = jsonify({'service_unavailable': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def set_statement_timeout(timeout_ms):
+    """Cancel the PostgreSQL statements running longer than the timeout
+    (in ms) until the end of the current transaction, including the later
+    fetches of its cursors. A no-op on other databases or without a
+    timeout.
+    """
+    if timeout_ms and db.engine.dialect.name == 'postgresql':
+        # The commit or the rollback of the transaction resets it
+        db.session.execute('SET LOCAL statement_timeout = %d' % timeout_ms)
+
+def init_app(app):
+    """Install the admission hooks of the limited routes and turn the
+    cancelled statements into 503 responses.
+    """
+
+    controller = AdmissionController(
+        limits=app.config.get('ADMISSION_LIMITS'),
+        default_limit=app.config.get('ADMISSION_DEFAULT_LIMIT'),
+        queue_size=app.config.get('ADMISSION_QUEUE_SIZE', 0),
+        queue_timeout=app.config.get('ADMISSION_QUEUE_TIMEOUT', 0),
+        retry_after=app.config.get('ADMISSION_RETRY_AFTER', 1))
+    app.extensions['admission'] = controller
+
+    @app.before_request
+    def admit_request():
+        limiter = controller.limiter(request.endpoint)
+        if limiter is None:
+            return None
+        if not limiter.acquire():
+            return _unavailable('The server is busy, please retry later',
+                controller.retry_after)
+        g.admission_limiter = limiter
+
+    @app.teardown_request
+    def release_request(exception=None):
+        # Streamed responses hold their slot until fully sent
+        limiter = getattr(g, 'admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+    @app.errorhandler(OperationalError)
+    def statement_timed_out(error):
+        if getattr(error.orig, 'pgcode', None) != QUERY_CANCELED:
+            raise error
+        db.session.rollback()
+        return _unavailable('The query took too long, please narrow the ' +
+            'filters or retry later', controller.retry_after)
@@ -0,0 +1,231 @@
+"""
+    acmewines.cache
+    ~~~~~~~~~~~~~~~
+
+    This module caches serialized responses keyed on normalized filter
+    parameters. Entries are stamped with a generation that every order
+    write bumps, so a write makes all the older entries unreachable.
+    Single orders are kept by id in an index dropping the written ids.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+
+from flask import json
+
+from acmewines import app
+from acmewines.models import Order
+from acmewines.utils.lru import LRUCache
+
+
+class DictCacheBackend(object):
+    """ Provide the interface of a shared cache backend (get, set with a
+    TTL and an atomic incr) in memory, e.g. as a stand-in for Redis or
+    memcached in tests.
+    """
+
+    def __init__(self):
+        self._values = LRUCache(max_entries=10000)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._values.set(key, value, ttl)
+
+    def incr(self, key):
+        with self._lock:
+            value = (self._values.get(key) or 0) + 1
+            self._values.set(key, value)
+            return value
+
+
+class ResponseCache(object):
+    """ Provide a two-tier (local LRU, optional shared backend) cache of
+    serialized responses invalidated by a generation stamp.
+    """
+
+    def __init__(self, namespace, max_entries=256, ttl=30, backend=None):
+        self._namespace = namespace
+        self._ttl = ttl
+        self._local = LRUCache(max_entries, ttl)
+        self._backend = backend
+        self._generation = 0
+        self._invalidated_at = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        """Get the current generation of the cached entries"""
+        if self._backend is not None:
+            return self._backend.get(self._namespace + ':generation') or 0
+        return self._generation
+
+    @property
+    def invalidated_at(self):
+        """Get the time of the last invalidation"""
+        if self._backend is not None:
+            return max(self._invalidated_at,
+                self._backend.get(self._namespace + ':invalidated_at') or 0)
+        return self._invalidated_at
+
+    def invalidate(self, *args):
+        """Make every cached entry stale by bumping the generation"""
+        now = time.time()
+        if self._backend is not None:
+            self._backend.incr(self._namespace + ':generation')
+            self._backend.set(self._namespace + ':invalidated_at', now)
+        with self._lock:
+            self._generation += 1
+            self._invalidated_at = now
+        self._local.clear()
+
+    def make_key(self, params):
+        """Build the cache key of the canonical form of the parameters"""
+        canonical_params = json.dumps(params, sort_keys=True,
+            separators=(',', ':'))
+        return '%s:%d:%s' % (self._namespace, self.generation,
+            hashlib.sha1(canonical_params.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        value = self._local.get(key)
+        if value is None and self._backend is not None:
+            value = self._backend.get(key)
+            if value is not None:
+                self._local.set(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._local.set(key, value)
+        if self._backend is not None:
+            self._backend.set(key, value, self._ttl)
+
+    def stats(self):
+        """Get the hit/miss counters and the size of the local tier"""
+        return {'hits': self.hits, 'misses': self.misses,
+            'entries': len(self._local), 'generation': self.generation}
+
+
+class LocalPubSub(object):
+    """ Provide the interface of a pub/sub channel (publish, subscribe
+    with a callback) within the process, e.g. as a stand-in for Redis
+    pub/sub in tests.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, message):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(message)
+
+
+class OrderIndex(object):
+    """ Keep the single orders as pre-encoded JSON bytes with their
+    last modification time in a local LRU, including the ids known to be
+    missing. Writes drop the entries of their ids here and, through the
+    pub/sub channel, in the other worker processes.
+    """
+
+    channel = 'acmewines:orders:invalidate'
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=30,
+        pubsub=None):
+        self._entries = LRUCache(max_entries, ttl)
+        self._negative_ttl = negative_ttl
+        self._pubsub = pubsub
+        self._origin = uuid.uuid4().hex
+        self._version = 0
+        # The time of the last drop, here or in another process
+        self.dropped_at = 0
+        self._lock = threading.Lock()
+        if pubsub is not None:
+            pubsub.subscribe(self.channel, self._on_message)
+
+    @property
+    def version(self):
+        """Get the version to pass to set, read before loading an order"""
+        return self._version
+
+    def get(self, id):
+        """Get the (body, last_modified) entry of the order, with a None
+        body for a missing order, or None when it is not cached.
+        """
+        return self._entries.get(id)
+
+    def set(self, id, body, last_modified, version):
+        """Cache the order loaded at the version, unless a write happened
+        since then. A None body caches the order as missing.
+        """
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries.set(id, (body, last_modified),
+                self._negative_ttl if body is None else None)
+
+    def _drop(self, ids):
+        with self._lock:
+            self._version += 1
+            self.dropped_at = time.time()
+            if ids is None:
+                self._entries.clear()
+            else:
+                for id in ids:
+                    self._entries.delete(id)
+
+    def invalidate(self, ids=None):
+        """Drop the written orders (every order when ids is None) here and
+        in the subscribed processes.
+        """
+        self._drop(ids)
+        if self._pubsub is not None:
+            self._pubsub.publish(self.channel, json.dumps({'origin':
+                self._origin, 'ids': ids if ids is None else list(ids)}))
+
+    def _on_message(self, message):
+        message = json.loads(message)
+        if message['origin'] != self._origin:
+            self._drop(message['ids'])
+
+
+# Cache of the GET /orders responses, dropped on every order write. The
+# generation is only shared through a backend, without one the writes of
+# the other processes go unseen and the responses get a short TTL instead.
+_order_list_cache_backend = app.config.get('ORDERS_CACHE_BACKEND')
+order_list_cache = ResponseCache('orders',
+    max_entries=app.config.get('ORDERS_CACHE_SIZE', 256),
+    ttl=app.config.get('ORDERS_CACHE_TTL', 30) if _order_list_cache_backend
+        else app.config.get('ORDERS_CACHE_LOCAL_TTL', 5),
+    backend=_order_list_cache_backend)
+Order.on_write(order_list_cache.invalidate)
+
+# Index of the GET /orders/<id> responses, dropped by id on every write.
+# Without a shared pub/sub, the writes only reach the index of their own
+# process and the orders are kept for a short TTL instead.
+_order_index_pubsub = app.config.get('ORDERS_INDEX_PUBSUB')
+_order_index_ttl = app.config.get('ORDERS_INDEX_TTL', 300)\
+    if _order_index_pubsub else app.config.get('ORDERS_INDEX_LOCAL_TTL', 5)
+order_index = OrderIndex(
+    max_entries=app.config.get('ORDERS_INDEX_SIZE', 10000),
+    ttl=_order_index_ttl,
+    negative_ttl=min(_order_index_ttl,
+        app.config.get('ORDERS_INDEX_NEGATIVE_TTL', 30)),
+    pubsub=_order_index_pubsub or LocalPubSub())
+Order.on_write(order_index.invalidate)
@@ -0,0 +1,160 @@
+"""
+    acmewines.emails
+    ~~~~~~~~~~~~~~~~
+
+    This module verifies the email addresses of the orders: their syntax
+    and, when enabled, the MX records of their domains. The MX lookups are
+    cached per domain and run concurrently, once per domain, for batches
+"""
+
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from validate_email import validate_email
+
+from acmewines import app
+from acmewines.utils.lru import LRUCache
+
+
+class PyDNSResolver(object):
+    """ Look up MX records with pyDNS, the resolver of validate_email. """
+
+    def __init__(self, timeout=5):
+        try:
+            import DNS
+        except ImportError:
+            raise RuntimeError('Checking the MX records requires pyDNS, ' +
+                'install it with "pip install pyDNS"')
+        DNS.DiscoverNameServers()
+        self._dns = DNS
+        self._timeout = timeout
+
+    def mx_hosts(self, domain):
+        """Get the MX hosts of the domain, the preferred first"""
+        try:
+            records = self._dns.mxlookup(domain, timeout=self._timeout)
+        except self._dns.ServerError as error:
+            # The domain does not exist
+            if error.rcode == 3:
+                return []
+            raise
+        return [host for priority, host in sorted(records)]
+
+
+class StubResolver(object):
+    """ Answer MX lookups from a dict mapping the domains to their MX hosts
+    (or to an exception to raise), e.g. as a stand-in for the DNS in tests.
+    """
+
+    def __init__(self, records=None):
+        self.records = records or {}
+        self.lookups = []
+
+    def mx_hosts(self, domain):
+        self.lookups.append(domain)
+        hosts = self.records.get(domain, [])
+        if isinstance(hosts, Exception):
+            raise hosts
+        return hosts
+
+
+class EmailVerifier(object):
+    """ Verify email addresses, with the MX verdicts of their domains
+    cached in a local LRU and an optional shared backend providing get and
+    set with a TTL.
+    """
+
+    def __init__(self, check_mx=False, resolver=None, max_entries=10000,
+        ttl=3600, negative_ttl=300, backend=None, workers=16):
+        self.check_mx = check_mx
+        # Fail at startup rather than on the first order without a resolver
+        if check_mx and resolver is None:
+            resolver = PyDNSResolver()
+        self._resolver = resolver
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._local = LRUCache(max_entries)
+        self._backend = backend
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def resolver(self):
+        with self._lock:
+            if self._resolver is None:
+                self._resolver = PyDNSResolver()
+            return self._resolver
+
+    def _cached_verdict(self, domain):
+        verdict = self._local.get(domain)
+        if verdict is None and self._backend is not None:
+            verdict = self._backend.get('mx:' + domain)
+            if verdict is not None:
+                self._local.set(domain, verdict, self._ttl)
+        return verdict
+
+    def _resolve(self, domain):
+        """Look up whether the domain has MX hosts. A failed lookup gives
+        None, and the domain is then given the benefit of the doubt.
+        """
+        try:
+            verdict = bool(self.resolver.mx_hosts(domain))
+        except Exception:
+            app.logger.warning('The MX lookup of %s failed' % domain)
+            return None
+        ttl = self._ttl if verdict else self._negative_ttl
+        self._local.set(domain, verdict, ttl)
+        if self._backend is not None:
+            self._backend.set('mx:' + domain, verdict, ttl)
+        return verdict
+
+    def has_mx(self, domain):
+        verdict = self._cached_verdict(domain)
+        if verdict is None:
+            verdict = self._resolve(domain)
+        return verdict is not False
+
+    def verify(self, email):
+        """Check the syntax of the address and the MX of its domain"""
+        if not validate_email(email):
+            return False
+        return not self.check_mx or self.has_mx(email.rsplit('@', 1)[1])
+
+    def verify_many(self, emails):
+        """Verify the addresses, resolving each uncached domain once and
+        concurrently. Return a dict mapping the addresses to their verdict.
+        """
+        verdicts = dict((email, bool(validate_email(email)))
+            for email in set(emails))
+        if not self.check_mx:
+            return verdicts
+        domain_verdicts = {}
+        for email, verdict in verdicts.items():
+            domain = email.rsplit('@', 1)[1] if verdict else None
+            if domain is not None and domain not in domain_verdicts:
+                domain_verdicts[domain] = self._cached_verdict(domain)
+        missed_domains = [domain for domain, verdict in
+            domain_verdicts.items() if verdict is None]
+        if missed_domains:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self._workers)
+            domain_verdicts.update(zip(missed_domains,
+                self._pool.map(self._resolve, missed_domains)))
+        for email, verdict in verdicts.items():
+            if verdict:
+                verdicts[email] =\
+                    domain_verdicts[email.rsplit('@', 1)[1]] is not False
+        return verdicts
+
+
+email_verifier = EmailVerifier(
+    check_mx=app.config.get('EMAIL_CHECK_MX', False),
+    resolver=app.config.get('EMAIL_RESOLVER'),
+    max_entries=app.config.get('EMAIL_MX_CACHE_SIZE', 10000),
+    ttl=app.config.get('EMAIL_MX_CACHE_TTL', 3600),
+    negative_ttl=app.config.get('EMAIL_MX_NEGATIVE_TTL', 300),
+    backend=app.config.get('EMAIL_MX_CACHE_BACKEND'),
+    workers=app.config.get('EMAIL_VERIFY_WORKERS', 16))
@@ -0,0 +1,194 @@
+"""
+    acmewines.instrumentation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module times the stages of every request (SQL, query, serialize)
+    and reports them through Server-Timing headers, structured logs and
+    the latency histograms of the /metrics endpoint
+"""
+
+import cProfile
+import logging
+import pstats
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from flask import Response, g, has_request_context, json, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (in ms) of the latency histogram buckets
+latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """ Count observed latencies into cumulative buckets. """
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RequestMetrics(object):
+    """ Keep the latency histograms per route and filter type. """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, filter_type, stage, duration):
+        key = (route, filter_type, stage)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(duration)
+
+    def render(self):
+        """Render the histograms in the Prometheus text format"""
+        lines = ['# TYPE acmewines_request_duration_ms histogram']
+        with self._lock:
+            for (route, filter_type, stage), histogram in\
+                sorted(self._histograms.items()):
+                labels = 'route="%s",filter_type="%s",stage="%s"' %\
+                    (route, filter_type, stage)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('acmewines_request_duration_ms_bucket' +
+                        '{%s,le="%s"} %d' % (labels, bound, count))
+                lines.append('acmewines_request_duration_ms_bucket' +
+                    '{%s,le="+Inf"} %d' % (labels, histogram.count))
+                lines.append('acmewines_request_duration_ms_sum{%s} %.3f' %
+                    (labels, histogram.sum))
+                lines.append('acmewines_request_duration_ms_count{%s} %d' %
+                    (labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+# The JSON lines of the requests, apart from app.logger whose messages
+# below warnings are dropped outside of the debug mode
+request_logger = logging.getLogger('acmewines.requests')
+
+@contextmanager
+def timed(stage):
+    """Add the time spent in the block to the stage of the request"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if has_request_context() and hasattr(g, 'stage_timings'):
+            g.stage_timings[stage] = g.stage_timings.get(stage, 0) +\
+                (time.time() - start_time) * 1000
+
+def filter_type_of(url_params):
+    """Get the label of the kinds of filters used by the request"""
+    filter_types = set()
+    for param in url_params:
+        if param.endswith('_equals'):
+            filter_types.add('equals')
+        elif param.endswith('_contains'):
+            filter_types.add('contains')
+        elif param in ('limit', 'offset', 'cursor', 'after_id', 'valid'):
+            filter_types.add(param)
+    return '+'.join(sorted(filter_types)) or 'none'
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+    executemany):
+    # Kept on the execution context, which a failed statement drops too
+    if context is not None:
+        context._query_start_time = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+    executemany):
+    start_time = getattr(context, '_query_start_time', None)
+    if start_time is None:
+        return
+    if has_request_context() and hasattr(g, 'stage_timings'):
+        g.stage_timings['sql'] = g.stage_timings.get('sql', 0) +\
+            (time.time() - start_time) * 1000
+        g.sql_count += 1
+
+def init_app(app):
+    """Install the request hooks, the SQL timing events and the /metrics
+    endpoint on the application.
+    """
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    if not request_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        request_logger.addHandler(handler)
+    request_logger.setLevel(app.config.get('REQUEST_LOG_LEVEL',
+        logging.INFO))
+    request_logger.propagate = False
+
+    @app.before_request
+    def start_timing():
+        g.request_start_time = time.time()
+        g.stage_timings = {}
+        g.sql_count = 0
+        g.profiler = None
+        if app.config.get('PROFILING_ENABLED', False) and\
+            request.args.get('profile', '') in ('1', 'true', 'yes'):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def report_timing(response):
+        if not hasattr(g, 'stage_timings'):
+            return response
+        total = (time.time() - g.request_start_time) * 1000
+        timings = dict(g.stage_timings, total=total)
+        route = request.endpoint or 'unknown'
+        filter_type = filter_type_of(request.args)
+        for stage, duration in timings.items():
+            request_metrics.observe(route, filter_type, stage, duration)
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.3f' %
+            (stage, duration) for stage, duration in sorted(timings.items()))
+        request_logger.info(json.dumps({'event': 'request', 'route': route,
+            'method': request.method, 'path': request.path,
+            'status': response.status_code, 'filter_type': filter_type,
+            'sql_count': g.sql_count, 'timings_ms': dict((stage,
+            round(duration, 3)) for stage, duration in timings.items())},
+            sort_keys=True))
+        if g.profiler is not None:
+            profiler, g.profiler = g.profiler, None
+            profiler.disable()
+            report = StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative')\
+                .print_stats(30)
+            # The summary replaces the body of the profiled request
+            response = Response(report.getvalue(), mimetype='text/plain',
+                headers={'Server-Timing': response.headers['Server-Timing']})
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exception=None):
+        # The after_request hooks are skipped when the view raises
+        profiler = getattr(g, 'profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            g.profiler = None
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(request_metrics.render(),
+            mimetype='text/plain; version=0.0.4')
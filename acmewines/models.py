@@ -1,16 +1,37 @@
 import re
 
 from datetime import datetime, date
+from numbers import Integral
 from sqlalchemy.dialects.postgresql import JSON as PSQLJSON
+from sqlalchemy import inspect
+from sqlalchemy.exc import DataError, IntegrityError
 
 from flask import json
 
-from acmewines import db
+from acmewines import app, db
+from acmewines.emails import email_verifier
+from acmewines.validators import BatchOrderValidator, validation_rules
+
+class JSONText(db.TypeDecorator):
+    """ Store JSON as text on backends without a JSON type (e.g. the
+    SQLite databases of the benchmarks).
+    """
+    impl = db.Text
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = json.dumps(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = json.loads(value)
+        return value
 
 class Order(db.Model):
     __tablename__ = 'orders'
     __mapper_args__ = {
-        'exclude_properties': ['created_at', 'updated_at']
+        'exclude_properties': ['created_at']
     }
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=False)
@@ -20,17 +41,31 @@ class Order(db.Model):
     zipcode_column = db.Column('zipcode', db.String(20), nullable=True)
     birthday_column = db.Column('birthday', db.Date, nullable=True)
     valid = db.Column(db.Boolean, nullable=True)
-    validation_failure = db.Column(PSQLJSON, nullable=True)
-    created_at = db.Column(db.DateTime, server_default=db.text('NOW()'))
-    updated_at = db.Column(db.DateTime, server_default=db.text('NOW()'),
-        onupdate=datetime.now)
+    validation_failure = db.Column(PSQLJSON().with_variant(JSONText, 'sqlite'),
+        nullable=True)
+    # Stamped by the database clock, in UTC, so that every process agrees
+    # on the Last-Modified validators
+    created_at = db.Column(db.DateTime(timezone=True),
+        server_default=db.func.now())
+    updated_at = db.Column(db.DateTime(timezone=True),
+        server_default=db.func.now(), onupdate=db.func.now())
     ix_state_zipcode = db.Index('ix_orders_state_zipcode', state_column, zipcode_column)
+    ix_zipcode = db.Index('ix_orders_zipcode', zipcode_column)
+    # Serves the lower(name) = :value comparison of the name_equals filter
+    ix_name_lower = db.Index('ix_orders_name_lower', db.func.lower(name_column))
+    # Trigram indexes serving the ILIKE '%...%' partial match filters
+    ix_name_trgm = db.Index('ix_orders_name_trgm', name_column,
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    ix_email_trgm = db.Index('ix_orders_email_trgm', email_column,
+        postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+    ix_zipcode_trgm = db.Index('ix_orders_zipcode_trgm', zipcode_column,
+        postgresql_using='gin', postgresql_ops={'zipcode': 'gin_trgm_ops'})
 
     _visible = ('id', 'name', 'email', 'state', 'zipcode', 'birthday',
         'valid', 'validation_failure')
 
-    from acmewines.configs.validation import required_fields
-    _required = required_fields
+    # Callbacks run with the written ids after every committed write
+    _write_listeners = []
 
     # Properties
     @property
@@ -131,7 +166,7 @@ class Order(db.Model):
 
     def _validate_missing_fields(self):
         validation_errors = {}
-        for field in Order._required:
+        for field in validation_rules.get().required_fields:
             if getattr(self, field, None) is None:
                 validation_errors['required_'+field] =\
                     'The %s is missing' % field
@@ -142,8 +177,7 @@ class Order(db.Model):
 
     def _validate_email(self, value):
         email_errors = {'email_validation': None}
-        from validate_email import validate_email
-        is_valid = validate_email(value)
+        is_valid = email_verifier.verify(value)
         if not is_valid:
             email_errors['email_validation'] =\
                 'The email address is not valid'
@@ -152,59 +186,47 @@ class Order(db.Model):
     def _validate_state(self, value):
         state_errors = {'state_validation': None,
             'allowed_states': None}
-        from acmewines.configs.validation import (
-            states, states_not_allowed)
-        if value in states:
-            if value in states_not_allowed:
-                state_errors['allowed_states'] =\
-                    "We don't ship to " + value
-        else:
-            state_errors['state_validation'] = value +\
-                ' is not a valid/allowed U.S. state abbreviation'
+        state_errors.update(validation_rules.get().check_state(value) or {})
         return state_errors
 
     def _validate_zipcode(self, value):
         zipcode_errors = {'zipcode_validation': None,
             'zipcode_digit_sum': None}
-        from acmewines.configs.validation import (
-            zipcode_pattern, zipcode_max_digit_sum)
-        is_valid = re.match(zipcode_pattern, value)
-        if is_valid:
-            zipcode_digit_sum = 0
-            for digit in value:
-                if digit != '-':
-                    zipcode_digit_sum += int(digit)
-            if zipcode_digit_sum > zipcode_max_digit_sum:
-                zipcode_errors['zipcode_digit_sum'] =\
-                    "The sum of zipcode's digits " +\
-                    'is too large (> %d)' % zipcode_max_digit_sum
-        else:
-            zipcode_errors['zipcode_validation'] = value + ' is not a valid' +\
-                '5-digit (e.g., 00000) or 9-digit (e.g., 00000-0000) zipcode'
+        zipcode_errors.update(
+            validation_rules.get().check_zipcode(value) or {})
         return zipcode_errors
 
     def _parse_and_validate_birthday(self, value):
         parsed_birthday = None
         birthday_errors = {'birthday_validation': None,
             'age_restriction': None}
-        from acmewines.configs.validation import (
-            birthday_format, min_age)
+        ruleset = validation_rules.get()
         try:
-            parsed_birthday = datetime.strptime(value, birthday_format).date()
+            parsed_birthday = datetime.strptime(value,
+                ruleset.birthday_format).date()
         except ValueError:
             pass
         if parsed_birthday:
-            today = date.today()
-            max_birth_date = date(today.year-21, today.month, today.day)
-            if parsed_birthday > max_birth_date:
+            if parsed_birthday > ruleset.age_cutoff():
                 birthday_errors['age_restriction'] =\
-                    'You must be %d or older to order' % min_age
+                    'You must be %d or older to order' % ruleset.min_age
         else:
             birthday_errors['birtday_validation'] =\
                 '%s is not a valid birthday format: %s' %\
-                (value, birthday_format)
+                (value, ruleset.birthday_format)
         return parsed_birthday, birthday_errors
 
+    @classmethod
+    def visible_columns(cls):
+        """Get the mapped columns backing the visible fields, in order"""
+        columns = []
+        for field_name in cls._visible:
+            if hasattr(cls, field_name + '_column'):
+                columns.append(getattr(cls, field_name + '_column'))
+            else:
+                columns.append(getattr(cls, field_name))
+        return columns
+
     def toDict(self):
         fieldDict = {}
         for field_name in Order._visible:
@@ -216,5 +238,299 @@ class Order(db.Model):
     def save(self):
         missing_field_errors = self._validate_missing_fields()
         self._update_validation_failure(missing_field_errors)  
+        self._update_rollups()
         db.session.add(self)
         db.session.commit()
+        Order._notify_write([self.id])
+
+    def _update_rollups(self):
+        stored_rows = []
+        if inspect(self).persistent:
+            # The JSON failures are mutated in place, so read the stored row
+            with db.session.no_autoflush:
+                stored_rows = db.session.query(Order.state_column,
+                    Order.valid, Order.validation_failure)\
+                    .filter(Order.id == self.id).all()
+        update_rollups(stored_rows,
+            [(self.state_column, self.valid, self.validation_failure)])
+
+    @classmethod
+    def on_write(cls, listener):
+        """Register a callback run with the list of written order ids
+        (None when unknown) after every committed write.
+        """
+        cls._write_listeners.append(listener)
+        return listener
+
+    @classmethod
+    def _notify_write(cls, ids):
+        for listener in cls._write_listeners:
+            listener(ids)
+
+    @staticmethod
+    def _check_record(record):
+        """Get the raw fields of a record with its id cast to int. Raise a
+        ValueError describing the problem if the record is unusable.
+        """
+        if not isinstance(record, dict):
+            raise ValueError('The order must be an object of fields')
+        id = record.get('id')
+        # Only integers and their decimal strings are ids, neither floats
+        # nor booleans are truncated into one
+        if isinstance(id, Integral) and not isinstance(id, bool):
+            fields = {'id': int(id)}
+        elif isinstance(id, (type(u''), type(''))) and\
+            re.match(r'^\s*[-+]?\d+\s*$', id):
+            fields = {'id': int(id)}
+        else:
+            raise ValueError('The id is missing or not an integer')
+        # The id column is a 32-bit integer
+        if not -2 ** 31 <= fields['id'] < 2 ** 31:
+            raise ValueError('The id is out of range')
+        for field_name in ('name', 'email', 'state', 'zipcode', 'birthday'):
+            field_value = record.get(field_name)
+            if field_value is not None and\
+                not isinstance(field_value, (type(u''), type(''))):
+                raise ValueError('The %s must be a string' % field_name)
+            column_type = getattr(Order, field_name + '_column').type
+            max_length = getattr(column_type, 'length', None)
+            if field_value is not None and max_length and\
+                len(field_value.strip()) > max_length:
+                raise ValueError('The %s is longer than %d characters' %
+                    (field_name, max_length))
+            fields[field_name] = field_value
+        return fields
+
+    @classmethod
+    def save_many(cls, records, chunk_size=None):
+        """Validate and insert many orders given as dicts of raw field
+        values, committing once per chunk. Unusable or conflicting
+        records are reported instead of aborting the batch.
+
+        Return the number of saved orders and the list of errors, each
+        holding the index of the rejected record and the reason.
+        """
+        if chunk_size is None:
+            chunk_size = app.config.get('ORDERS_BULK_CHUNK_SIZE', 1000)
+        num_of_orders = 0
+        errors = []
+        chunk = []
+        for index, record in enumerate(records):
+            try:
+                chunk.append((index, cls._check_record(record)))
+            except ValueError as error:
+                errors.append({'index': index, 'error': str(error)})
+            if len(chunk) >= chunk_size:
+                num_of_orders += cls._insert_chunk(chunk, errors)
+                chunk = []
+        if chunk:
+            num_of_orders += cls._insert_chunk(chunk, errors)
+        errors.sort(key=lambda error: error['index'])
+        return num_of_orders, errors
+
+    @staticmethod
+    def _validate_records(records):
+        """Validate the raw fields of many records in one pass and get
+        their column values for a bulk insert.
+        """
+        columns = dict((field_name, [fields[field_name] for fields in records])
+            for field_name in ('id', 'name', 'email', 'state', 'zipcode',
+            'birthday'))
+        validated = BatchOrderValidator().validate(columns)
+        return [{'id': validated['id'][row],
+            'name_column': validated['name'][row],
+            'email_column': validated['email'][row],
+            'state_column': validated['state'][row],
+            'zipcode_column': validated['zipcode'][row],
+            'birthday_column': validated['birthday'][row],
+            'valid': validated['valid'][row],
+            'validation_failure': validated['validation_failure'][row]}
+            for row in range(len(records))]
+
+    @classmethod
+    def _insert_chunk(cls, chunk, errors):
+        # Drop the orders whose id is repeated or already stored
+        chunk_ids = set()
+        existing_ids = set(row[0] for row in db.session.query(cls.id)\
+            .filter(cls.id.in_([fields['id'] for _, fields in chunk])))
+        accepted = []
+        for index, fields in chunk:
+            if fields['id'] in existing_ids or fields['id'] in chunk_ids:
+                errors.append({'index': index, 'id': fields['id'],
+                    'error': 'The order of id=%d already exists' %
+                    fields['id']})
+            else:
+                chunk_ids.add(fields['id'])
+                accepted.append((index, fields))
+        if not accepted:
+            return 0
+        mappings = list(zip([index for index, _ in accepted],
+            cls._validate_records([fields for _, fields in accepted])))
+        try:
+            db.session.bulk_insert_mappings(cls,
+                [mapping for _, mapping in mappings])
+            update_rollups([], [(mapping['state_column'], mapping['valid'],
+                mapping['validation_failure']) for _, mapping in mappings])
+            db.session.commit()
+            cls._notify_write([mapping['id'] for _, mapping in mappings])
+            return len(mappings)
+        except (DataError, IntegrityError):
+            db.session.rollback()
+        # A concurrent writer got in first or the database rejected a row,
+        # so fall back to row by row
+        num_of_orders = 0
+        for index, mapping in mappings:
+            try:
+                db.session.bulk_insert_mappings(cls, [mapping])
+                update_rollups([], [(mapping['state_column'],
+                    mapping['valid'], mapping['validation_failure'])])
+                db.session.commit()
+                cls._notify_write([mapping['id']])
+                num_of_orders += 1
+            except (DataError, IntegrityError) as error:
+                db.session.rollback()
+                errors.append({'index': index, 'id': mapping['id'],
+                    'error': str(error.orig)})
+        return num_of_orders
+
+
+class _RollupMixin(object):
+    """ Provide the maintenance of a table of order counts per key. """
+
+    _key_columns = ()
+
+    @classmethod
+    def increment(cls, changes):
+        """Apply the changes of the counts within the current transaction.
+        The keys are updated in sorted order, so that concurrent writers
+        lock the rows in the same order instead of deadlocking.
+        """
+        table = cls.__table__
+        rows = [dict(zip(cls._key_columns, key), count=change)
+            for key, change in sorted(changes.items()) if change]
+        if not rows:
+            return
+        if db.engine.dialect.name == 'postgresql':
+            # A single statement per key, safe against a concurrent insert
+            # of the same key
+            db.session.execute(db.text(
+                'INSERT INTO %s (%s, count) VALUES (%s, :count) ' % (
+                table.name, ', '.join(cls._key_columns),
+                ', '.join(':' + column_name
+                    for column_name in cls._key_columns)) +
+                'ON CONFLICT (%s) ' % ', '.join(cls._key_columns) +
+                'DO UPDATE SET count = %s.count + excluded.count' %
+                table.name), rows)
+            return
+        for row in rows:
+            update = table.update().values(count=table.c.count + row['count'])
+            for column_name in cls._key_columns:
+                update = update.where(table.c[column_name] == row[column_name])
+            if not db.session.execute(update).rowcount:
+                db.session.execute(table.insert().values(**row))
+
+    @classmethod
+    def total(cls, **key_values):
+        """Get the number of orders, optionally restricted to some keys"""
+        query = db.session.query(db.func.coalesce(db.func.sum(cls.count), 0))
+        for column_name, value in key_values.items():
+            if value is not None:
+                query = query.filter(getattr(cls, column_name) == value)
+        return int(query.scalar())
+
+
+class OrderCount(_RollupMixin, db.Model):
+    """ Keep the number of orders per state and validity, maintained by
+    the write paths of Order so totals need no scan of the orders.
+    """
+    __tablename__ = 'order_counts'
+    _key_columns = ('state', 'valid')
+
+    state = db.Column(db.String(30), primary_key=True)
+    valid = db.Column(db.Boolean, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<OrderCount: state=%s, valid=%r>' % (self.state, self.valid)
+
+    @classmethod
+    def rebuild(cls):
+        """Recount the orders from scratch within the current transaction"""
+        state = db.func.coalesce(Order.state_column, '')
+        db.session.execute(cls.__table__.delete())
+        db.session.execute(cls.__table__.insert().from_select(
+            ['state', 'valid', 'count'],
+            db.select([state, Order.valid, db.func.count(Order.id)])\
+            .where(Order.valid.isnot(None)).group_by(state, Order.valid)))
+
+
+class OrderFailureCount(_RollupMixin, db.Model):
+    """ Keep the number of orders per state and validation failure key. """
+    __tablename__ = 'order_failure_counts'
+    _key_columns = ('state', 'failure_key')
+
+    state = db.Column(db.String(30), primary_key=True)
+    failure_key = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<OrderFailureCount: state=%s, failure_key=%s>' %\
+            (self.state, self.failure_key)
+
+    @classmethod
+    def rebuild(cls):
+        """Recount the failures from scratch within the current transaction"""
+        db.session.execute(cls.__table__.delete())
+        changes = {}
+        rows = db.session.query(Order.state_column, Order.validation_failure)\
+            .filter(Order.valid == False).yield_per(10000)
+        for state, validation_failure in rows:
+            for failure_key in validation_failure or {}:
+                key = (state or '', failure_key)
+                changes[key] = changes.get(key, 0) + 1
+        cls.increment(changes)
+
+
+def update_rollups(removed_rows, added_rows):
+    """Update the order rollups within the current transaction, given the
+    (state, valid, validation_failure) of the removed and added orders.
+    """
+    count_changes = {}
+    failure_changes = {}
+    for sign, rows in ((-1, removed_rows), (1, added_rows)):
+        for state, valid, validation_failure in rows:
+            key = (state or '', valid)
+            count_changes[key] = count_changes.get(key, 0) + sign
+            for failure_key in validation_failure or {}:
+                key = (state or '', failure_key)
+                failure_changes[key] = failure_changes.get(key, 0) + sign
+    OrderCount.increment(count_changes)
+    OrderFailureCount.increment(failure_changes)
+
+def rebuild_rollups():
+    """Rebuild every order rollup within the current transaction"""
+    OrderCount.rebuild()
+    OrderFailureCount.rebuild()
+
+
+def _compile_row_mapper(field_names, converters):
+    """Build a function turning a row of visible columns into the same
+    dict as Order.toDict()
+    """
+    fields = tuple((field_name, converters.get(field_name))
+        for field_name in field_names)
+    def row_mapper(row):
+        fieldDict = {}
+        for (field_name, converter), field_value in zip(fields, row):
+            if field_value is not None:
+                if converter is not None:
+                    field_value = converter(field_value)
+                fieldDict[field_name] = field_value
+        return fieldDict
+    return row_mapper
+
+Order.row_to_dict = staticmethod(_compile_row_mapper(Order._visible,
+    {'birthday': date.isoformat}))
+
+# The writer reads its writes back from the primary for a while
+Order.on_write(db.router.note_write)
@@ -0,0 +1,250 @@
+"""
+    acmewines.routing
+    ~~~~~~~~~~~~~~~~~
+
+    This module sends the read-only queries to the read replicas in turn,
+    skipping the unhealthy ones, while the writes and the reads following
+    a write of the same client stay on the primary
+"""
+
+import math
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import sqlalchemy
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool
+
+# The cookie carrying the time of the last write of the client
+STICKY_COOKIE = 'acmewines_last_write'
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Replace the pooled connections which died while checked in"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool retries the checkout with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class ReplicaRouter(object):
+    """ Pick the replica engine of the read-only queries, round robin
+    among the replicas which answered their last health check. The checks
+    run in a background thread of every process, so that no request waits
+    on a replica which is down.
+    """
+
+    def __init__(self, db, app):
+        self._db = db
+        self._app = app
+        self._uris = list(app.config.get('SQLALCHEMY_REPLICA_URIS') or ())
+        self.health_check_seconds = app.config.get(
+            'REPLICA_HEALTH_CHECK_SECONDS', 10)
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 5)
+        self._engines = None
+        self._healthy = [True] * len(self._uris)
+        self._checker_pid = None
+        self._next = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_engines(self):
+        with self._lock:
+            if self._engines is None:
+                self._engines = []
+                for i, uri in enumerate(self._uris):
+                    # Replicas get the pool settings of the primary
+                    info = make_url(uri)
+                    options = {'convert_unicode': True}
+                    self._db.apply_pool_defaults(self._app, options)
+                    self._db.apply_driver_hacks(self._app, info, options)
+                    if info.drivername.startswith('postgresql'):
+                        # Give up quickly on a replica which is unreachable
+                        options['connect_args'] = {'connect_timeout':
+                            self._app.config.get('REPLICA_CONNECT_TIMEOUT',
+                            2)}
+                    engine = sqlalchemy.create_engine(info, **options)
+                    event.listen(engine, 'handle_error',
+                        self._make_error_handler(i))
+                    self._engines.append(engine)
+            # The threads of the parent are gone in a forked worker
+            if self._engines and self._checker_pid != os.getpid():
+                self._checker_pid = os.getpid()
+                thread = threading.Thread(target=self._run_health_checks)
+                thread.daemon = True
+                thread.start()
+            return self._engines
+
+    def _make_error_handler(self, i):
+        def handle_error(context):
+            if context.is_disconnect:
+                self._healthy[i] = False
+        return handle_error
+
+    def _check(self, i, engine):
+        try:
+            connection = engine.connect()
+            try:
+                connection.scalar(select([1]))
+            finally:
+                connection.close()
+            self._healthy[i] = True
+        except exc.DBAPIError:
+            if self._healthy[i]:
+                self._app.logger.warning('The read replica #%d is down' % i)
+            self._healthy[i] = False
+
+    def _run_health_checks(self):
+        while True:
+            for i, engine in enumerate(self._engines or ()):
+                self._check(i, engine)
+            time.sleep(self.health_check_seconds)
+
+    def mark_down(self, engine):
+        """Stop reading from the replica until its next health check"""
+        for i, replica in enumerate(self._engines or ()):
+            if replica is engine:
+                self._healthy[i] = False
+
+    def read_engine(self):
+        """Get the replica engine of the next read-only query, or None when
+        it has to read from the primary.
+        """
+        if not self._uris or self.is_sticky():
+            return None
+        engines = self._get_engines()
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(engines)
+        for offset in range(len(engines)):
+            i = (start + offset) % len(engines)
+            if self._healthy[i]:
+                return engines[i]
+        return None
+
+    def note_write(self, ids=None):
+        """Read from the primary for a while after a write, a write
+        listener of the orders.
+        """
+        now = time.time()
+        if has_request_context():
+            g.last_write_at = now
+        else:
+            self._local.last_write_at = now
+
+    def is_sticky(self):
+        last_write_at = getattr(self._local, 'last_write_at', 0)
+        if has_request_context():
+            last_write_at = max(last_write_at, getattr(g, 'last_write_at', 0))
+            try:
+                last_write_at = max(last_write_at,
+                    float(request.cookies.get(STICKY_COOKIE, 0)))
+            except ValueError:
+                pass
+        return time.time() - last_write_at < self.sticky_seconds
+
+    def may_lag(self, written_at):
+        """Whether a replica may have yet to replay a write made at the
+        time, so that the reads from it must not be cached.
+        """
+        return bool(self._uris) and\
+            time.time() - written_at < self.sticky_seconds
+
+    @contextmanager
+    def replica_reads(self):
+        """Send the queries of the block to a replica when possible"""
+        previous = getattr(self._local, 'replica_reads', False)
+        self._local.replica_reads = True
+        try:
+            yield
+        finally:
+            self._local.replica_reads = previous
+
+    def reading_from_replica(self):
+        return getattr(self._local, 'replica_reads', False)
+
+    def set_sticky_cookie(self, response):
+        """Make the following requests of the writer stick to the primary"""
+        last_write_at = getattr(g, 'last_write_at', None)
+        if last_write_at is not None and self._uris:
+            response.set_cookie(STICKY_COOKIE, '%.3f' % last_write_at,
+                max_age=int(math.ceil(self.sticky_seconds)))
+        return response
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._engines or ():
+                engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    """ A session sending the queries of the replica_reads blocks to a
+    replica, unless it has pending changes to flush first. The session
+    keeps its replica until closed, so that the queries of a request see
+    the same snapshot.
+    """
+
+    def __init__(self, db, **options):
+        self._router = db.router
+        self._replica = None
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._router.reading_from_replica() and not self._flushing and\
+            not (self.new or self.dirty or self.deleted) and\
+            not self._router.is_sticky():
+            if self._replica is None:
+                self._replica = self._router.read_engine()
+            if self._replica is not None:
+                return self._replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def fall_back_to_primary(self):
+        """Stop reading from the replica of the session after it failed,
+        and roll back its transaction. Return False when the session was
+        not reading from a replica.
+        """
+        if self._replica is None:
+            return False
+        self._router.mark_down(self._replica)
+        self.rollback()
+        self._replica = None
+        return True
+
+    def close(self):
+        self._replica = None
+        SignallingSession.close(self)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ The SQLAlchemy integration with replica routing and pre-pinged
+    pooled connections.
+    """
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        # The sizes and the timeout only apply to queue pools, while SQLite
+        # gets a null (file) or static (in memory) pool rejecting them
+        if info.drivername.startswith('sqlite'):
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+        self.router = ReplicaRouter(self, app)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING', False):
+            event.listen(Pool, 'checkout', _ping_connection)
+        app.after_request(self.router.set_sticky_cookie)
@@ -0,0 +1,147 @@
+"""
+    acmewines.serializers
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    This module encodes the order responses in the format picked by the
+    Accept header: compact JSON, MessagePack (when msgpack is installed)
+    or column-oriented JSON for analytics clients
+"""
+
+from flask import Response, json, request
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from acmewines import app
+from acmewines.models import Order
+
+
+class Serializer(object):
+    """ Encode a response payload whose 'results' are order dicts. """
+
+    name = None
+    mimetype = None
+
+    def dumps(self, payload):
+        raise NotImplementedError()
+
+    def dumps_encoded(self, payload, encoded_results):
+        """Dump the payload with its results given as JSON-encoded bytes"""
+        return self.dumps(dict(payload, results=[json.loads(result)
+            for result in encoded_results]))
+
+    def recode(self, encoded_payload):
+        """Dump a payload given as JSON-encoded bytes"""
+        return self.dumps(json.loads(encoded_payload))
+
+
+class JSONSerializer(Serializer):
+    """ Encode compact JSON, with ujson when it is installed. """
+
+    name = 'json'
+    mimetype = 'application/json'
+
+    def dumps(self, payload):
+        if ujson is not None:
+            return ujson.dumps(payload, ensure_ascii=False,
+                escape_forward_slashes=False).encode('utf-8')
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+    def dumps_encoded(self, payload, encoded_results):
+        # Splice the encoded results in rather than decoding them
+        head = self.dumps(payload)[:-1]
+        return head + (b',' if payload else b'') + b'"results":[' +\
+            b','.join(encoded_results) + b']}'
+
+    def recode(self, encoded_payload):
+        return encoded_payload
+
+
+class ColumnarJSONSerializer(JSONSerializer):
+    """ Encode the results as one list of values per field. The results
+    which are not orders (e.g. the not_found messages of a batch lookup)
+    are listed apart, under their own key.
+    """
+
+    name = 'columnar'
+    mimetype = 'application/vnd.acmewines.columnar+json'
+
+    def dumps(self, payload):
+        if 'results' in payload:
+            orders = []
+            payload = dict(payload)
+            for result in payload['results']:
+                if 'id' in result:
+                    orders.append(result)
+                else:
+                    for key, value in result.items():
+                        payload.setdefault(key, []).append(value)
+            payload['results'] = dict((field_name,
+                [order.get(field_name) for order in orders])
+                for field_name in Order._visible)
+        return JSONSerializer.dumps(self, payload)
+
+    def dumps_encoded(self, payload, encoded_results):
+        return Serializer.dumps_encoded(self, payload, encoded_results)
+
+    def recode(self, encoded_payload):
+        return Serializer.recode(self, encoded_payload)
+
+
+class MessagePackSerializer(Serializer):
+    """ Encode MessagePack. """
+
+    name = 'msgpack'
+    mimetype = 'application/x-msgpack'
+
+    def dumps(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+
+# The available serializers, the default first
+json_serializer = JSONSerializer()
+serializers = [json_serializer, ColumnarJSONSerializer()]
+if msgpack is not None:
+    serializers.append(MessagePackSerializer())
+
+# Both are pinned in requirements.txt, an install without them still
+# serves JSON but more slowly or without MessagePack
+if ujson is None:
+    app.logger.warning('ujson is not installed, the JSON responses are ' +
+        'encoded by the slower json module')
+if msgpack is None:
+    app.logger.warning('msgpack is not installed, the order responses are ' +
+        'not offered as MessagePack')
+
+def negotiate():
+    """Get the serializer of the format the client accepts best"""
+    mimetype = request.accept_mimetypes.best_match(
+        [serializer.mimetype for serializer in serializers])
+    for serializer in serializers:
+        if serializer.mimetype == mimetype:
+            return serializer
+    return serializers[0]
+
+def make_response(body, serializer):
+    """Build the response of a body encoded by the serializer"""
+    response = Response(body, mimetype=serializer.mimetype)
+    response.vary.add('Accept')
+    return response
+
+def render(payload, serializer=None, encoded_results=None):
+    """Build the response of the payload in the negotiated format. The
+    results may be given apart as JSON-encoded bytes.
+    """
+    serializer = serializer or negotiate()
+    if encoded_results is None:
+        body = serializer.dumps(payload)
+    else:
+        body = serializer.dumps_encoded(payload, encoded_results)
+    return make_response(body, serializer)
@@ -0,0 +1,157 @@
+"""
+    acmewines.slowqueries
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    This module records the order queries slower than a threshold, with
+    their filters, SQL and query plan, in a bounded ring buffer
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from collections import deque
+
+from flask import json
+
+from acmewines import app
+
+
+def filter_shape(effect_filter_params):
+    """Get the filters of the parameters without their values, e.g.
+    'constraint.limit+field_partial_match.name'
+    """
+    shape = []
+    for filter_type, filters in (effect_filter_params or {}).items():
+        for filter_name in filters:
+            shape.append(filter_type + '.' + filter_name)
+    return '+'.join(sorted(shape)) or 'unfiltered'
+
+def plan_summary(plan):
+    """Get the scan nodes of a captured plan, e.g. 'Seq Scan on orders',
+    to tell which queries miss an index.
+    """
+    if not plan:
+        return 'no plan captured'
+    if isinstance(plan, list) and plan and isinstance(plan[0], dict):
+        # A PostgreSQL JSON plan
+        nodes = []
+        pending = [plan[0]['Plan']]
+        while pending:
+            node = pending.pop()
+            if 'Relation Name' in node:
+                nodes.append('%s on %s%s' % (node['Node Type'],
+                    node['Relation Name'], ' using ' + node['Index Name']
+                    if 'Index Name' in node else ''))
+            pending.extend(node.get('Plans', []))
+        return '; '.join(nodes)
+    # A SQLite query plan, whose rows end with the detail
+    return '; '.join(str(row[-1]) for row in plan)
+
+
+class SlowQueryLog(object):
+    """ Keep the last slow query records in memory, or in a SQLite file
+    shared by the processes of one host when a path is given.
+    """
+
+    _fields = ('id', 'recorded_at', 'shape', 'filters', 'statement',
+        'parameters', 'duration_ms', 'plan')
+
+    def __init__(self, threshold_ms=500, max_records=1000, path=None):
+        self.threshold_ms = threshold_ms
+        self._max_records = max_records
+        self.path = path
+        self._records = deque(maxlen=max_records)
+        self._next_id = 1
+        self._lock = threading.Lock()
+        if path:
+            with self._connect() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS slow_queries (' +
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, recorded_at REAL, ' +
+                    'shape TEXT, filters TEXT, statement TEXT, ' +
+                    'parameters TEXT, duration_ms REAL, plan TEXT)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, effect_filter_params, statement, parameters,
+        duration_ms):
+        """Record the query if it is slow. Return the id of the record, or
+        None when the query was fast enough.
+        """
+        if duration_ms < self.threshold_ms:
+            return None
+        record = {'recorded_at': time.time(),
+            'shape': filter_shape(effect_filter_params),
+            'filters': effect_filter_params, 'statement': statement,
+            'parameters': parameters, 'duration_ms': duration_ms,
+            'plan': None}
+        if self.path:
+            with self._lock, self._connect() as connection:
+                cursor = connection.execute('INSERT INTO slow_queries (' +
+                    ', '.join(self._fields[1:]) + ') VALUES (?, ?, ?, ?, ' +
+                    '?, ?, ?)', (record['recorded_at'], record['shape'],
+                    json.dumps(record['filters']), statement,
+                    json.dumps(parameters, default=str), duration_ms, None))
+                record_id = cursor.lastrowid
+                # Drop the oldest records beyond the size of the buffer
+                connection.execute('DELETE FROM slow_queries WHERE id <= ?',
+                    (record_id - self._max_records,))
+            return record_id
+        with self._lock:
+            record['id'] = record_id = self._next_id
+            self._next_id += 1
+            self._records.append(record)
+        return record_id
+
+    def set_plan(self, record_id, plan):
+        """Attach the query plan captured afterwards to its record"""
+        if self.path:
+            with self._lock, self._connect() as connection:
+                connection.execute('UPDATE slow_queries SET plan = ? ' +
+                    'WHERE id = ?', (json.dumps(plan), record_id))
+            return
+        with self._lock:
+            for record in self._records:
+                if record['id'] == record_id:
+                    record['plan'] = plan
+
+    def records(self):
+        """Get the kept records, the oldest first"""
+        if self.path:
+            with self._lock, self._connect() as connection:
+                rows = connection.execute('SELECT %s FROM slow_queries ' %
+                    ', '.join(self._fields) + 'ORDER BY id').fetchall()
+            records = []
+            for row in rows:
+                record = dict(zip(self._fields, row))
+                for field in ('filters', 'parameters', 'plan'):
+                    if record[field] is not None:
+                        record[field] = json.loads(record[field])
+                records.append(record)
+            return records
+        with self._lock:
+            return [dict(record) for record in self._records]
+
+    def shapes(self):
+        """Aggregate the kept records by filter shape, the slowest first"""
+        shapes = {}
+        for record in self.records():
+            shape = shapes.setdefault(record['shape'], {'shape':
+                record['shape'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            shape['count'] += 1
+            shape['total_ms'] += record['duration_ms']
+            shape['max_ms'] = max(shape['max_ms'], record['duration_ms'])
+        for shape in shapes.values():
+            shape['mean_ms'] = shape['total_ms'] / shape['count']
+        return sorted(shapes.values(), key=lambda shape: -shape['total_ms'])
+
+
+# Shared through slow_queries.db in the project directory, unless
+# SLOW_QUERY_LOG_PATH is set to None to keep the records in memory
+slow_query_log = SlowQueryLog(
+    threshold_ms=app.config.get('SLOW_QUERY_THRESHOLD_MS', 500),
+    max_records=app.config.get('SLOW_QUERY_LOG_SIZE', 1000),
+    path=app.config.get('SLOW_QUERY_LOG_PATH',
+        os.path.join(os.path.dirname(app.root_path), 'slow_queries.db')))
@@ -5,20 +5,328 @@
     This module contains independent (synchonous/asynchronous) tasks.
 """ 
 
+import os
+import re
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from flask import json
 from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from acmewines import app, db
+from acmewines.admission import QUERY_CANCELED, set_statement_timeout
+from acmewines.models import Order, OrderCount, OrderFailureCount
+from acmewines.slowqueries import slow_query_log
+from acmewines.utils.lru import LRUCache
+
+class Task(object):
+    """ Provide the base of the tasks, which either run synchronously
+    through run() or get queued to the worker pool through submit().
+    """
+
+    def run(self):
+        raise NotImplementedError
+
+    def run_job(self):
+        """Run the task in a worker and return a JSON-serializable result"""
+        return self.run()
+
+    def submit(self):
+        """Queue the task to the worker pool and return the job id"""
+        return task_queue.submit(self)
+
+
+class MemoryJobStore(object):
+    """ Keep the job statuses in the memory of the process. """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id, task_name):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'task': task_name,
+                'status': 'queued', 'result': None, 'error': None,
+                'created_at': now, 'updated_at': now}
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def expire(self, max_age):
+        """Drop the jobs done (finished or failed) for over max_age seconds"""
+        expired_at = time.time() - max_age
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job['status'] in ('finished', 'failed') and\
+                    job['updated_at'] < expired_at:
+                    del self._jobs[job_id]
+
+
+class SQLiteJobStore(object):
+    """ Keep the job statuses in a SQLite database file, so they can be
+    shared by the worker processes of one host.
+    """
+
+    _fields = ('id', 'task', 'status', 'result', 'error', 'created_at',
+        'updated_at')
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (' +
+                'id TEXT PRIMARY KEY, task TEXT, status TEXT, result TEXT, ' +
+                'error TEXT, created_at REAL, updated_at REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def create(self, job_id, task_name):
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            connection.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, task_name, 'queued', None, None, now, now))
+
+    def update(self, job_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        names = sorted(fields)
+        with self._lock, self._connect() as connection:
+            connection.execute('UPDATE jobs SET %s WHERE id = ?' %
+                ', '.join('%s = ?' % name for name in names),
+                [fields[name] for name in names] + [job_id])
+
+    def get(self, job_id):
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT %s FROM jobs WHERE id = ?' %
+                ', '.join(self._fields), (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self._fields, row))
+        if job['result'] is not None:
+            job['result'] = json.loads(job['result'])
+        return job
+
+    def expire(self, max_age):
+        """Drop the jobs done (finished or failed) for over max_age seconds"""
+        with self._lock, self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE status IN " +
+                "('finished', 'failed') AND updated_at < ?",
+                (time.time() - max_age,))
+
+
+class TaskQueue(object):
+    """ Provide a pool of worker threads running the submitted tasks and
+    recording their statuses in a job store.
+    """
+
+    def __init__(self, store, workers=4, result_ttl=3600):
+        self.store = store
+        self._workers = workers
+        self._result_ttl = result_ttl
+        self._expired_at = time.time()
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        """Queue the task and return the id of its job"""
+        self._expire()
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, type(task).__name__)
+        self._start_workers()
+        self._queue.put((job_id, task))
+        return job_id
+
+    def _expire(self):
+        # Sweep the jobs done for longer than their TTL, at most once a
+        # minute
+        with self._lock:
+            if self._result_ttl is None or\
+                time.time() - self._expired_at < 60:
+                return
+            self._expired_at = time.time()
+        self.store.expire(self._result_ttl)
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id, task = self._queue.get()
+            self.store.update(job_id, status='running')
+            try:
+                with app.app_context():
+                    result = task.run_job()
+                self.store.update(job_id, status='finished', result=result)
+            except Exception:
+                app.logger.exception('Task of job %s failed', job_id)
+                self.store.update(job_id, status='failed',
+                    error=traceback.format_exc().splitlines()[-1])
+            finally:
+                db.session.remove()
+                self._queue.task_done()
+
+    def join(self):
+        """Block until every queued task has been run"""
+        self._queue.join()
+
+
+def compile_query(query):
+    """Render the query for the current database, returning the SQL and
+    its parameters in the paramstyle of the DBAPI driver.
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    if compiled.positional:
+        return str(compiled), tuple(compiled.params[name]
+            for name in compiled.positiontup)
+    return str(compiled), compiled.params
+
+
+def normalize_statement(statement):
+    """Get the statement with its placeholders, and the lists of them
+    (e.g. of an IN clause), collapsed into a single ?.
+    """
+    statement = re.sub(r'%\(\w+\)s|\?', '?', statement)
+    statement = re.sub(r'\?(\s*,\s*\?)+', '?', statement)
+    return ' '.join(statement.split())
+
+
+class ExplainLimiter(object):
+    """ Admit the capture of a plan once per normalized statement every
+    cooldown seconds, and up to max_in_flight captures at once.
+    """
+
+    def __init__(self, cooldown=300, max_in_flight=2, max_entries=1000):
+        self._explained = LRUCache(max_entries, cooldown)
+        self._max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, statement):
+        """Return whether the plan of the statement should be captured"""
+        key = normalize_statement(statement)
+        with self._lock:
+            if self._in_flight >= self._max_in_flight or\
+                self._explained.get(key) is not None:
+                return False
+            self._explained.set(key, True)
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+
+class ExplainTask(Task):
+    """ Provide a task to capture the plan of a recorded slow query. """
+
+    def __init__(self, record_id, statement, parameters):
+        self._record_id = record_id
+        self._statement = statement
+        self._parameters = parameters
+
+    def run_job(self):
+        try:
+            return self.run()
+        finally:
+            explain_limiter.release()
+
+    def run(self):
+        connection = db.session.connection()
+        if db.engine.dialect.name == 'postgresql':
+            # ANALYZE runs the query again, in a rolled back transaction,
+            # cancelled past the timeout
+            set_statement_timeout(
+                app.config.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 10000))
+            plan = connection.execute('EXPLAIN (ANALYZE, BUFFERS, ' +
+                'FORMAT JSON) ' + self._statement, self._parameters).scalar()
+            db.session.rollback()
+        elif db.engine.dialect.name == 'sqlite':
+            plan = [list(row) for row in connection.execute(
+                'EXPLAIN QUERY PLAN ' + self._statement, self._parameters)]
+        else:
+            plan = None
+        slow_query_log.set_plan(self._record_id, plan)
+        return {'record_id': self._record_id}
+
 
-from acmewines.models import Order
+explain_limiter = ExplainLimiter(
+    cooldown=app.config.get('SLOW_QUERY_EXPLAIN_COOLDOWN', 300),
+    max_in_flight=app.config.get('SLOW_QUERY_EXPLAIN_MAX_IN_FLIGHT', 2))
 
-class OrderFilterTask(object):
+# The job statuses are shared by the worker processes through a SQLite
+# file, unless TASK_STORE_PATH is set to None to keep them in memory
+_job_store_path = app.config.get('TASK_STORE_PATH',
+    os.path.join(os.path.dirname(app.root_path), 'jobs.db'))
+if _job_store_path:
+    _job_store = SQLiteJobStore(_job_store_path)
+else:
+    _job_store = MemoryJobStore()
+task_queue = TaskQueue(_job_store, workers=app.config.get('TASK_WORKERS', 4),
+    result_ttl=app.config.get('TASK_RESULT_TTL', 3600))
+
+
+def read_from_replica(function):
+    """Run the queries of the function on a replica and again on the
+    primary when the replica fails. The statement timeout covers the rest
+    of the transaction, so it also cancels the fetches of a streamed query.
+    """
+    timeout_ms = app.config.get('ORDERS_STATEMENT_TIMEOUT_MS')
+    try:
+        with db.router.replica_reads():
+            set_statement_timeout(timeout_ms)
+            return function()
+    except OperationalError as error:
+        # A cancelled query would be as slow on the primary
+        if getattr(error.orig, 'pgcode', None) == QUERY_CANCELED or\
+            not db.session().fall_back_to_primary():
+            raise
+        app.logger.warning('A read replica failed, reading from the ' +
+            'primary: %s' % error.orig)
+    set_statement_timeout(timeout_ms)
+    return function()
+
+
+class OrderFilterTask(Task):
     """ Provide a task to filter the output orders. """
 
     def __init__(self, url_params=None):
-        self._allowed_filters = {'constraint': ['limit', 'offset', 'valid'],
+        self._allowed_filters = {'constraint': ['limit', 'offset', 'valid',
+                'after_id', 'cursor'],
             'field_match': ['name', 'email', 'state', 'zipcode'],
             'field_partial_match': ['name', 'email', 'zipcode']
         }
         self._query = Order.query.order_by(Order.id)
         self._effect_filter_params = {}
+        self._warnings = []
+        self._next_cursor = None
         if url_params:
             self._parse_filter_params(url_params)
 
@@ -27,6 +335,22 @@ class OrderFilterTask(object):
         """Get the effect filter parameters for the order filter task"""
         return self._effect_filter_params or None
 
+    @property
+    def warnings(self):
+        """Get the warnings raised while parsing the filter parameters"""
+        return self._warnings or None
+
+    @property
+    def next_cursor(self):
+        """Get the cursor of the next page after the task has been run"""
+        return self._next_cursor
+
+    @staticmethod
+    def encode_cursor(order_id):
+        """Encode an order id into an opaque pagination cursor"""
+        return urlsafe_b64encode(('id:%d' % order_id).encode('ascii'))\
+            .decode('ascii')
+
     def _parse_filter_params(self, url_params):
         if 'constraint' in self._allowed_filters:
             self._parse_constraint_filters(url_params)
@@ -40,6 +364,11 @@ class OrderFilterTask(object):
             if filter_name == 'valid':
                 filter_value = url_params.get(filter_name, None,
                     type=self._cast_var_to_boolean)
+            elif filter_name == 'cursor':
+                # An opaque cursor is just another spelling of after_id
+                filter_value = url_params.get(filter_name, None,
+                    type=self._cast_var_to_cursor)
+                filter_name = 'after_id'
             else:
                 filter_value = url_params.get(filter_name, None,
                     type=self._cast_var_to_positive_int)
@@ -48,10 +377,24 @@ class OrderFilterTask(object):
                     self._effect_filter_params['constraint'] = {}
                 self._effect_filter_params['constraint'][filter_name] =\
                     filter_value
+        self._check_offset_filter()
+
+    def _check_offset_filter(self):
+        # A deep offset scans every skipped row, the cursor does not
+        constraints = self._effect_filter_params.get('constraint', {})
+        max_offset = app.config.get('ORDERS_MAX_OFFSET', 10000)
+        if constraints.get('offset', 0) > max_offset:
+            raise ValueError('The offset must not exceed %d, use the ' %
+                max_offset + 'cursor/after_id parameter to page further')
 
     def _parse_fieldmatch_filters(self, url_params):
         for field in self._allowed_filters['field_match']:
-            filter_value = url_params.get(field + '_equals', '')
+            # Normalize the value the same way the Order setters do
+            filter_value = url_params.get(field + '_equals', '').strip()
+            if field == 'email':
+                filter_value = filter_value.lower()
+            elif field == 'state':
+                filter_value = filter_value.upper()
             if filter_value != '':
                 if 'field_match' not in self._effect_filter_params:
                     self._effect_filter_params['field_match'] = {}
@@ -86,22 +429,274 @@ class OrderFilterTask(object):
         else:
            return None
 
-    def run(self):
+    def _cast_var_to_cursor(self, value):
+        try:
+            decoded_value = urlsafe_b64decode(value.encode('ascii'))\
+                .decode('ascii')
+        except (BinasciiError, TypeError, ValueError):
+            return None
+        if decoded_value.startswith('id:'):
+            return self._cast_var_to_positive_int(decoded_value[3:])
+        else:
+            return None
+
+    def _apply_filters(self, query, with_cursor=True):
+        # The task may run in a worker thread, use that thread's session
+        query = query.with_session(db.session())
         for filter_type in self._effect_filter_params:
             for filter_name, filter_value in\
                 self._effect_filter_params[filter_type].items():
                 if filter_type == 'constraint':
-                    if filter_name == 'limit':
-                       self._query = self._query.limit(filter_value)
-                    elif filter_name == 'offset':
-                       self._query = self._query.offset(filter_value)
-                    elif filter_name == 'valid':
-                        self._query = self._query.filter_by(
-                            valid = filter_value)
+                    if filter_name == 'valid':
+                        query = query.filter_by(valid = filter_value)
+                    elif filter_name == 'after_id' and with_cursor:
+                        query = query.filter(Order.id > filter_value)
                 elif filter_type == 'field_match':
-                    self._query = self._query.filter(func.lower(getattr(Order,
-                        filter_name + '_column')) == func.lower(filter_value))
+                    query = query.filter(self._field_match_clause(
+                        filter_name, filter_value))
                 elif filter_type =='field_partial_match':
-                    self._query = self._query.filter(getattr(Order,
-                        filter_name + '_column').ilike('%' + filter_value + '%'))
-        return self._query.all()
+                    query = query.filter(self._partial_match_clause(
+                        getattr(Order, filter_name + '_column'), filter_value))
+        return query
+
+    def _field_match_clause(self, field, value):
+        # Emails and states are stored (and parsed) in canonical case, so
+        # they compare against the raw column and its B-tree index. Names
+        # use the lower(name) expression index, and zipcodes only need
+        # lower() when the value has letters (i.e. it is invalid anyway).
+        column = getattr(Order, field + '_column')
+        if field == 'name' or\
+            (field == 'zipcode' and value.lower() != value.upper()):
+            return func.lower(column) == value.lower()
+        else:
+            return column == value
+
+    def _partial_match_clause(self, column, value):
+        # On PostgreSQL the pg_trgm GIN indexes serve ILIKE directly, other
+        # backends fall back to a plain scan. The trigram index can only
+        # narrow the search with at least 3 characters, so shorter values
+        # still scan.
+        escaped_value = value.replace('\\', '\\\\').replace('%', '\\%')\
+            .replace('_', '\\_')
+        return column.ilike('%' + escaped_value + '%', escape='\\')
+
+    def _apply_pagination(self, query):
+        # Pagination must be applied after the filters
+        constraints = self._effect_filter_params.get('constraint', {})
+        if 'limit' in constraints:
+            query = query.limit(constraints['limit'])
+        if 'offset' in constraints:
+            query = query.offset(constraints['offset'])
+        return query
+
+    def _update_next_cursor(self, last_id, num_of_orders):
+        limit = self._effect_filter_params.get('constraint', {}).get('limit')
+        if limit is not None and num_of_orders == limit:
+            self._next_cursor = self.encode_cursor(last_id)
+
+    def _build_query(self, as_dicts):
+        query = self._apply_pagination(self._apply_filters(self._query))
+        if as_dicts:
+            # Read-only path: fetch plain tuples, skip the ORM hydration
+            query = query.with_entities(*Order.visible_columns())
+        self._query = query
+        return query
+
+    def freshness(self):
+        """Get the latest updated_at and the number of the orders the task
+        would return, in a single aggregate query.
+        """
+        page = self._apply_pagination(self._apply_filters(self._query))\
+            .with_entities(Order.updated_at).subquery()
+        query = db.session.query(func.max(page.c.updated_at), func.count())\
+            .select_from(page)
+        start_time = time.time()
+        freshness = read_from_replica(query.one)
+        self._log_if_slow(query, start_time)
+        return freshness
+
+    def count(self, estimate=False):
+        """Count all the orders matching the filters, regardless of the
+        pagination. The unfiltered, state and validity cases are served
+        from the maintained order counts. Other filters run a count query,
+        or, with estimate set, read the planner's row estimate on
+        PostgreSQL.
+        """
+        constraints = dict(self._effect_filter_params.get('constraint', {}))
+        for filter_name in ('limit', 'offset', 'after_id'):
+            constraints.pop(filter_name, None)
+        field_matches = self._effect_filter_params.get('field_match', {})
+        if set(constraints) <= set(['valid']) and\
+            set(field_matches) <= set(['state']) and\
+            'field_partial_match' not in self._effect_filter_params:
+            return read_from_replica(lambda: OrderCount.total(
+                state=field_matches.get('state'),
+                valid=constraints.get('valid')))
+        query = self._apply_filters(self._query, with_cursor=False)\
+            .order_by(None)
+        if estimate and db.engine.dialect.name == 'postgresql':
+            return self._explain(query)[0]['Plan']['Plan Rows']
+        query = query.with_entities(func.count(Order.id))
+        start_time = time.time()
+        num_of_orders = read_from_replica(query.scalar)
+        self._log_if_slow(query, start_time)
+        return num_of_orders
+
+    def _explain(self, query, options='FORMAT JSON'):
+        """Get the PostgreSQL plan of the query as parsed JSON"""
+        statement, parameters = compile_query(query)
+        return db.session.connection().execute('EXPLAIN (%s) %s' %
+            (options, statement), parameters).scalar()
+
+    def _log_if_slow(self, query, start_time):
+        duration_ms = (time.time() - start_time) * 1000
+        if duration_ms < slow_query_log.threshold_ms:
+            return
+        statement, parameters = compile_query(query)
+        record_id = slow_query_log.record(self.effect_filter_params,
+            statement, parameters, duration_ms)
+        if record_id is not None and\
+            app.config.get('SLOW_QUERY_EXPLAIN', True) and\
+            explain_limiter.acquire(statement):
+            ExplainTask(record_id, statement, parameters).submit()
+
+    def run_job(self):
+        orders = self.run(as_dicts=True)
+        return {'effect_filters': self.effect_filter_params,
+            'num_of_orders': len(orders), 'next_cursor': self.next_cursor,
+            'results': orders}
+
+    def run(self, as_dicts=False):
+        """Run the task and return the filtered orders, or their
+        serialized dicts when as_dicts is set.
+        """
+        query = self._build_query(as_dicts)
+        start_time = time.time()
+        rows = read_from_replica(query.all)
+        self._log_if_slow(query, start_time)
+        if as_dicts:
+            orders = [Order.row_to_dict(row) for row in rows]
+            if orders:
+                self._update_next_cursor(orders[-1]['id'], len(orders))
+        else:
+            orders = rows
+            if orders:
+                self._update_next_cursor(orders[-1].id, len(orders))
+        return orders
+
+    def iterate(self, batch_size=None, as_dicts=False):
+        """Yield the filtered orders (or their serialized dicts) in
+        batches through a server-side cursor instead of loading them all
+        into memory.
+        """
+        if batch_size is None:
+            batch_size = app.config.get('ORDERS_STREAM_BATCH_SIZE', 1000)
+        num_of_orders = 0
+        last_id = None
+        # The query runs as soon as the iteration starts
+        query = self._build_query(as_dicts).yield_per(batch_size)
+        rows = read_from_replica(lambda: iter(query))
+        for row in rows:
+            num_of_orders += 1
+            if as_dicts:
+                order = Order.row_to_dict(row)
+                last_id = order['id']
+            else:
+                order = row
+                last_id = order.id
+            yield order
+        if last_id is not None:
+            self._update_next_cursor(last_id, num_of_orders)
+
+
+class OrderStatsTask(OrderFilterTask):
+    """ Provide a task to break the orders down by state, validity and
+    validation failure from the maintained rollups, without scanning the
+    orders themselves.
+    """
+
+    _groupings = ('state', 'valid', 'failure')
+    # The failure rollup only holds the invalid orders, so it is only
+    # read when the failures are asked for
+    _default_group_by = ('state', 'valid')
+
+    def __init__(self, url_params=None):
+        super(OrderStatsTask, self).__init__()
+        # Only the filters the rollups are keyed on can be served
+        self._allowed_filters = {'constraint': ['valid'],
+            'field_match': ['state']}
+        self._group_by = list(self._default_group_by)
+        if url_params:
+            self._parse_filter_params(url_params)
+            self._parse_group_by_param(url_params)
+
+    @property
+    def group_by(self):
+        """Get the dimensions the orders are grouped by"""
+        return self._group_by
+
+    def _parse_group_by_param(self, url_params):
+        group_by = []
+        for grouping in url_params.get('group_by', '').split(','):
+            grouping = grouping.strip().lower()
+            if grouping in self._groupings and grouping not in group_by:
+                group_by.append(grouping)
+        if group_by:
+            self._group_by = group_by
+
+    def count(self, estimate=False):
+        constraints = self._effect_filter_params.get('constraint', {})
+        field_matches = self._effect_filter_params.get('field_match', {})
+        return OrderCount.total(state=field_matches.get('state'),
+            valid=constraints.get('valid'))
+
+    def run_job(self):
+        return {'effect_filters': self.effect_filter_params,
+            'group_by': self.group_by, 'num_of_orders': self.count(),
+            'groups': self.run()}
+
+    def run(self):
+        """Run the task and return the number of orders of every group"""
+        valid = self._effect_filter_params.get('constraint', {}).get('valid')
+        state = self._effect_filter_params.get('field_match', {}).get('state')
+        if 'failure' in self._group_by:
+            # Only invalid orders have failures
+            if valid:
+                return []
+            rollup = OrderFailureCount
+            columns = {'state': rollup.state, 'failure': rollup.failure_key}
+        else:
+            rollup = OrderCount
+            columns = {'state': rollup.state, 'valid': rollup.valid}
+        group_by = [grouping for grouping in self._group_by
+            if grouping in columns]
+        group_columns = [columns[grouping] for grouping in group_by]
+        query = db.session.query(*(group_columns + [func.sum(rollup.count)]))
+        if state is not None:
+            query = query.filter(rollup.state == state)
+        if valid is not None and rollup is OrderCount:
+            query = query.filter(rollup.valid == valid)
+        query = query.group_by(*group_columns).order_by(*group_columns)
+        groups = []
+        for row in query:
+            group = dict(zip(group_by, row[:-1]))
+            if 'valid' in self._group_by and 'valid' not in group:
+                group['valid'] = False
+            group['num_of_orders'] = int(row[-1])
+            if group['num_of_orders']:
+                groups.append(group)
+        return groups
+
+
+class BulkImportTask(Task):
+    """ Provide a task to validate and save a batch of raw orders. """
+
+    def __init__(self, records, chunk_size=None):
+        self._records = records
+        self._chunk_size = chunk_size
+
+    def run(self):
+        num_of_orders, errors = Order.save_many(self._records,
+            chunk_size=self._chunk_size)
+        return {'num_of_orders': num_of_orders,
+            'num_of_errors': len(errors), 'errors': errors}
@@ -0,0 +1,254 @@
+"""
+    acmewines.utils.benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This is a module that benchmarks the order filtering, serialization
+    and listing against seeded data sets, and compares the results with
+    a previous run
+"""
+
+import io
+import json
+import os
+import platform
+import time
+
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import MultiDict
+
+from acmewines import app, db
+from acmewines.cache import order_list_cache, order_index
+from acmewines.models import Order
+from acmewines.serializers import serializers
+from acmewines.tasks import OrderFilterTask
+from acmewines.utils.export import export_formats, export_orders
+from acmewines.utils.populate import seed_bulk_data
+
+# A SQLite file in the project directory, relative paths would resolve
+# against the package directory
+DEFAULT_DATABASE_URI = 'sqlite:///' + os.path.join(
+    os.path.dirname(app.root_path), 'benchmark.db')
+
+def _prepare_database(database_uri, orders, seed):
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    db.session.remove()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.commit()
+    db.drop_all()
+    db.create_all()
+    # SQLite allows a single writer, so seed it from a single process
+    processes = 1 if db.engine.dialect.name == 'sqlite' else None
+    seed_bulk_data(orders=orders, seed=seed, processes=processes)
+
+def _filter_cases(orders):
+    """Get the GET /orders parameters to benchmark, one per filter type"""
+    ordered_orders = Order.query.order_by(Order.id)
+    sample = ordered_orders.offset(orders // 2).first()
+    # The small data sets have no order past the shallow offset
+    shallow_id = ordered_orders.offset(min(100, orders - 1)).first().id
+    deep_id = ordered_orders.offset(orders * 9 // 10).first().id
+    return [
+        ('unfiltered', {}),
+        ('limit', {'limit': '100'}),
+        ('limit_offset_shallow', {'limit': '100', 'offset': '100'}),
+        ('limit_offset_deep', {'limit': '100',
+            'offset': str(orders * 9 // 10)}),
+        ('limit_cursor_shallow', {'limit': '100',
+            'cursor': OrderFilterTask.encode_cursor(shallow_id)}),
+        ('limit_cursor_deep', {'limit': '100',
+            'cursor': OrderFilterTask.encode_cursor(deep_id)}),
+        ('valid', {'valid': 'true'}),
+        ('name_equals', {'name_equals': sample.name}),
+        ('email_equals', {'email_equals': sample.email}),
+        ('state_equals', {'state_equals': sample.state}),
+        ('zipcode_equals', {'zipcode_equals': sample.zipcode}),
+        ('name_contains', {'name_contains': sample.name.split()[-1]}),
+        ('email_contains', {'email_contains': sample.email.split('@')[1]}),
+        ('zipcode_contains', {'zipcode_contains': sample.zipcode[:3]}),
+    ]
+
+def _measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = default_timer()
+        function()
+        timings.append((default_timer() - start_time) * 1000)
+    timings.sort()
+    return {'median_ms': round(timings[len(timings) // 2], 3),
+        'p95_ms': round(timings[min(len(timings) - 1,
+            int(len(timings) * 0.95))], 3),
+        'min_ms': round(timings[0], 3)}
+
+def _run_filter_cases(orders, repeat):
+    client = app.test_client()
+    results = {}
+    for case_name, params in _filter_cases(orders):
+        url_params = MultiDict(params)
+        def end_to_end():
+            # Every request must miss the response cache
+            order_list_cache.invalidate()
+            client.get('/orders/', query_string=params)
+        results[case_name] = {
+            'parse': _measure(lambda: OrderFilterTask(url_params), repeat),
+            'query': _measure(lambda: OrderFilterTask(url_params).run(),
+                repeat),
+            'query_as_dicts': _measure(
+                lambda: OrderFilterTask(url_params).run(as_dicts=True),
+                repeat),
+            'end_to_end': _measure(end_to_end, repeat)}
+        db.session.remove()
+    return results
+
+def _run_lookup_cases(orders, repeat, num_of_ids=200):
+    """Time looking up orders one by one against a single batch lookup"""
+    client = app.test_client()
+    step = max(orders // num_of_ids, 1)
+    ids = [row[0] for row in Order.query.with_entities(Order.id)\
+        .order_by(Order.id).all()[::step][:num_of_ids]]
+    def one_by_one():
+        # Every lookup must miss the order index
+        order_index.invalidate()
+        for id in ids:
+            client.get('/orders/%d' % id)
+    def batch():
+        order_index.invalidate()
+        client.get('/orders/batch', query_string={'ids':
+            ','.join(str(id) for id in ids)})
+    results = {}
+    for case_name, function in (('one_by_one', one_by_one),
+        ('batch', batch)):
+        result = _measure(function, repeat)
+        result['orders_per_second'] = int(len(ids) /
+            max(result['median_ms'] / 1000, 1e-9))
+        results[case_name] = result
+    db.session.remove()
+    return results
+
+def _run_serialization_cases(repeat):
+    rows = OrderFilterTask().run()
+    tuples = Order.query.with_entities(*Order.visible_columns())\
+        .order_by(Order.id).all()
+    results = {}
+    for case_name, function in (
+        ('to_dict', lambda: [order.toDict() for order in rows]),
+        ('row_to_dict', lambda: [Order.row_to_dict(row) for row in tuples]),
+        ('export_csv', lambda: export_orders(OrderFilterTask(), 'csv',
+            io.BytesIO())),
+        ('export_ndjson', lambda: export_orders(OrderFilterTask(), 'ndjson',
+            io.BytesIO()))):
+        result = _measure(function, repeat)
+        result['rows_per_second'] = int(len(rows) /
+            max(result['median_ms'] / 1000, 1e-9))
+        results[case_name] = result
+    db.session.remove()
+    return results
+
+class _NullOutput(object):
+    """ Discard the exported bytes, so only the export itself uses memory. """
+
+    def write(self, data):
+        pass
+
+def _peak_memory_kb(function):
+    """Get the peak memory allocated while running the function, traced
+    by tracemalloc or else (on Python 2) approximated by the growth of the
+    peak RSS.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+
+def _run_export_memory_cases():
+    """Measure the peak memory of exporting every order, which must stay
+    flat as the data set grows.
+    """
+    results = {}
+    for export_format in sorted(export_formats):
+        for compress in (False, True):
+            case_name = export_format + ('_gzip' if compress else '')
+            results[case_name] = {'peak_kb': _peak_memory_kb(
+                lambda: export_orders(OrderFilterTask(), export_format,
+                _NullOutput(), compress=compress))}
+            db.session.remove()
+    return results
+
+def _run_format_cases(repeat):
+    """Time encoding the orders in every response format, scaled to 10k
+    orders, along with the encoded size.
+    """
+    orders = OrderFilterTask().run(as_dicts=True)
+    scale = 10000.0 / max(len(orders), 1)
+    payload = {'num_of_orders': len(orders), 'results': orders}
+    results = {}
+    for serializer in serializers:
+        result = _measure(lambda: serializer.dumps(payload), repeat)
+        result['ms_per_10k'] = round(result['median_ms'] * scale, 3)
+        result['bytes_per_10k'] = int(len(serializer.dumps(payload)) * scale)
+        results[serializer.name] = result
+    db.session.remove()
+    return results
+
+def run_benchmarks(sizes=(1000,), database_uri=DEFAULT_DATABASE_URI,
+    repeat=5, seed=0):
+    """Seed a data set of every size into the benchmark database (which
+    gets wiped) and time every benchmark case on it.
+    """
+    report = {'meta': {'database': make_url(database_uri).drivername,
+        'python': platform.python_version(), 'repeat': repeat, 'seed': seed,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': {}}
+    for orders in sizes:
+        _prepare_database(database_uri, orders, seed)
+        results = _run_filter_cases(orders, repeat)
+        results['serialization'] = _run_serialization_cases(repeat)
+        results['lookup'] = _run_lookup_cases(orders, repeat)
+        results['formats'] = _run_format_cases(repeat)
+        results['export_memory'] = _run_export_memory_cases()
+        report['results'][str(orders)] = results
+    return report
+
+def _iter_medians(results, path=()):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if 'median_ms' in value:
+                yield path + (key,), value['median_ms']
+            else:
+                for item in _iter_medians(value, path + (key,)):
+                    yield item
+
+def find_regressions(report, baseline, threshold=0.2):
+    """Compare the medians of a report with those of a baseline report and
+    return the cases that got slower by more than the threshold ratio.
+    """
+    baseline_medians = dict(_iter_medians(baseline['results']))
+    regressions = []
+    for path, median_ms in _iter_medians(report['results']):
+        baseline_ms = baseline_medians.get(path)
+        if baseline_ms and median_ms > baseline_ms * (1 + threshold):
+            regressions.append({'case': '/'.join(path),
+                'baseline_ms': baseline_ms, 'median_ms': median_ms})
+    return regressions
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
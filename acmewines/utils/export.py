@@ -0,0 +1,87 @@
+"""
+    acmewines.utils.export
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This is a module that exports filtered orders as CSV or NDJSON in
+    chunks, so that the memory in use stays constant for any number of
+    orders
+"""
+
+import csv
+import zlib
+
+try:
+    from cStringIO import StringIO
+    # The csv module of Python 2 only writes bytes, encode the text first
+    def _encode(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+except ImportError:
+    from io import StringIO
+    def _encode(value):
+        return value
+
+from flask import json
+
+from acmewines.models import Order
+
+export_formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    elif value is True or value is False:
+        return 'true' if value else 'false'
+    elif isinstance(value, dict):
+        return _encode(json.dumps(value, sort_keys=True))
+    else:
+        return _encode(value)
+
+def _utf8(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+def iter_export_chunks(order_filter_task, export_format, chunk_rows=1000):
+    """Yield the orders of the filter task as UTF-8 encoded chunks of
+    chunk_rows orders each, read through a server-side cursor.
+    """
+    buffer = StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(Order._visible)
+    num_of_rows = 0
+    for order in order_filter_task.iterate(as_dicts=True):
+        if export_format == 'csv':
+            writer.writerow([_csv_value(order.get(field_name))
+                for field_name in Order._visible])
+        else:
+            buffer.write(_encode(json.dumps(order) + '\n'))
+        num_of_rows += 1
+        if num_of_rows == chunk_rows:
+            yield _utf8(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            num_of_rows = 0
+    if buffer.tell():
+        yield _utf8(buffer.getvalue())
+
+def gzip_chunks(chunks, compresslevel=6):
+    """Compress a stream of chunks into a stream of gzip chunks"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+        16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_orders(order_filter_task, export_format, output, compress=True):
+    """Write the orders of the filter task into the binary file object.
+    Return the number of bytes written.
+    """
+    chunks = iter_export_chunks(order_filter_task, export_format)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    num_of_bytes = 0
+    for chunk in chunks:
+        output.write(chunk)
+        num_of_bytes += len(chunk)
+    return num_of_bytes
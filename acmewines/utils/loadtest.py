@@ -0,0 +1,73 @@
+"""
+    acmewines.utils.loadtest
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This is a module that loads a running server with concurrent clients
+    and reports the latency percentiles of the admitted and the rejected
+    requests, to check that the latency stays bounded under overload
+"""
+
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+
+
+def _percentile(timings, ratio):
+    if not timings:
+        return None
+    timings = sorted(timings)
+    return round(timings[min(len(timings) - 1, int(len(timings) * ratio))], 3)
+
+def _client(urls, deadline, timeout, results, lock):
+    i = 0
+    while time.time() < deadline:
+        url = urls[i % len(urls)]
+        i += 1
+        start_time = time.time()
+        try:
+            response = urlopen(url, timeout=timeout)
+            response.read()
+            status = response.getcode()
+        except HTTPError as error:
+            status = error.code
+        except (URLError, IOError):
+            status = 'error'
+        duration = (time.time() - start_time) * 1000
+        with lock:
+            results.setdefault(status, []).append(duration)
+
+def run_load_test(base_url, paths=('/orders/',), concurrency=50,
+    duration=30, timeout=30):
+    """Send requests for the paths in turn from concurrent clients for a
+    duration in seconds. Return the requests per second and the latency
+    percentiles (in ms) per response status.
+    """
+    urls = [base_url.rstrip('/') + path for path in paths]
+    deadline = time.time() + duration
+    results = {}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=_client,
+        args=(urls, deadline, timeout, results, lock))
+        for _ in range(concurrency)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+    report = {'concurrency': concurrency, 'duration': round(elapsed, 3),
+        'requests': sum(len(timings) for timings in results.values()),
+        'statuses': {}}
+    report['requests_per_second'] = round(report['requests'] / elapsed, 1)
+    for status, timings in results.items():
+        report['statuses'][str(status)] = {'count': len(timings),
+            'p50_ms': _percentile(timings, 0.5),
+            'p95_ms': _percentile(timings, 0.95),
+            'p99_ms': _percentile(timings, 0.99),
+            'max_ms': round(max(timings), 3)}
+    return report
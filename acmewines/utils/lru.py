@@ -0,0 +1,54 @@
+"""
+    acmewines.utils.lru
+    ~~~~~~~~~~~~~~~~~~~
+
+    This is a module that provides a thread-safe LRU mapping, free of any
+    dependency on the app so that every module can import it
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Provide a thread-safe, size-bounded LRU mapping with a TTL. """
+
+    def __init__(self, max_entries=256, ttl=None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                return None
+            # Re-insert to mark the entry as the most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self._ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
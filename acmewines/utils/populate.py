@@ -5,11 +5,21 @@
     This is a module that creats data for test
 """
 
-from random import getrandbits
+import time
+
+from datetime import date
+from multiprocessing import Pool
+from random import getrandbits, Random
 from faker import Faker
 
+from acmewines import db
 from acmewines.models import Order
-from acmewines.configs.validation import birthday_format
+from acmewines.configs.validation import birthday_format, states
+
+# The birthdays of the bulk orders are drawn between fixed dates, so that
+# a seed yields the same orders on any day. Some are too young to order.
+MIN_BIRTHDAY = date(1920, 1, 1)
+MAX_BIRTHDAY = date(2015, 12, 31)
 
 def seed_test_data(orders=20):
     """Create and save fake test data (orders) into database"""
@@ -17,6 +27,7 @@ def seed_test_data(orders=20):
     created_data = {'orders': 0}
 
     fake = Faker()
+    records = []
     for i in range(orders):
         id = fake.random_int(min=1, max=2147483647)
         name = fake.name()
@@ -26,9 +37,87 @@ def seed_test_data(orders=20):
         if getrandbits(1):
             zipcode = fake.zipcode_plus4()
         birthday = fake.date(birthday_format)
-        order = Order(id, name=name, email=email, state=state,
-            zipcode=zipcode, birthday=birthday)
-        order.save()
-        created_data['orders'] += 1
+        records.append({'id': id, 'name': name, 'email': email,
+            'state': state, 'zipcode': zipcode, 'birthday': birthday})
+
+    # Randomly drawn ids may collide, those orders are skipped
+    created_data['orders'], _ = Order.save_many(records)
+
+    return created_data
+
+def _make_vocabularies(seed, size=500):
+    """Draw the pools of names and email domains sampled by the bulk
+    generator, calling Faker only once per pool entry.
+    """
+    fake = Faker()
+    fake.seed(seed)
+    return {'first_names': [fake.first_name() for _ in range(size)],
+        'last_names': [fake.last_name() for _ in range(size)],
+        'domains': [fake.domain_name() for _ in range(size // 5)]}
+
+def _generate_records(vocabularies, first_id, num_of_orders, seed):
+    rng = Random(seed)
+    first_names = vocabularies['first_names']
+    last_names = vocabularies['last_names']
+    domains = vocabularies['domains']
+    min_birthday = MIN_BIRTHDAY.toordinal()
+    max_birthday = MAX_BIRTHDAY.toordinal()
+    records = []
+    for id in range(first_id, first_id + num_of_orders):
+        first_name = rng.choice(first_names)
+        last_name = rng.choice(last_names)
+        zipcode = '%05d' % rng.randint(0, 99999)
+        if rng.getrandbits(1):
+            zipcode += '-%04d' % rng.randint(0, 9999)
+        birthday = date.fromordinal(rng.randint(min_birthday, max_birthday))
+        records.append({'id': id, 'name': first_name + ' ' + last_name,
+            'email': '%s.%s%d@%s' % (first_name, last_name,
+                rng.randint(1, 999), rng.choice(domains)),
+            'state': rng.choice(states), 'zipcode': zipcode,
+            'birthday': birthday.strftime(birthday_format)})
+    return records
+
+def _init_worker():
+    # Connections inherited from the parent process must not be shared
+    db.engine.dispose()
+
+def _seed_block(args):
+    vocabularies, first_id, num_of_orders, seed = args
+    records = _generate_records(vocabularies, first_id, num_of_orders, seed)
+    num_of_saved_orders, _ = Order.save_many(records,
+        chunk_size=num_of_orders)
+    db.session.remove()
+    return num_of_saved_orders
+
+def seed_bulk_data(orders=100000, seed=0, processes=None, block_size=10000):
+    """Generate and save a large, reproducible set of fake orders with a
+    pool of processes. The orders take the ids following the largest
+    stored one, and every block of block_size orders is drawn from its
+    own RNG seeded from seed, so the data does not depend on the number
+    of processes.
+    """
+
+    created_data = {'orders': 0}
+
+    vocabularies = _make_vocabularies(seed)
+    first_id = (db.session.query(db.func.max(Order.id)).scalar() or 0) + 1
+    db.session.remove()
+    blocks = [(vocabularies, first_id + offset,
+        min(block_size, orders - offset), seed * 1000003 + offset)
+        for offset in range(0, orders, block_size)]
+
+    start_time = time.time()
+    pool = Pool(processes, initializer=_init_worker)
+    try:
+        for num_of_orders in pool.imap_unordered(_seed_block, blocks):
+            created_data['orders'] += num_of_orders
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start_time
+    created_data['orders_per_second'] =\
+        int(created_data['orders'] / max(elapsed, 1e-6))
 
+    # The workers bypassed the write listeners of this process
+    Order._notify_write(None)
     return created_data
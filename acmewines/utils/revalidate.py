@@ -0,0 +1,133 @@
+"""
+    acmewines.utils.revalidate
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This is a module that recomputes the validation state of the stored
+    orders after the validation rules have changed
+"""
+
+import json
+import os
+import time
+
+from multiprocessing import Pool
+
+from acmewines import db
+from acmewines.models import Order, update_rollups
+from acmewines.validators import BatchOrderValidator
+
+def _iter_id_ranges(chunk_size, after_id=None):
+    """Yield (first_id, last_id) ranges covering chunk_size orders each"""
+    query = db.session.query(Order.id).order_by(Order.id)
+    if after_id is not None:
+        query = query.filter(Order.id > after_id)
+    first_id = last_id = None
+    num_of_ids = 0
+    for (order_id,) in query.yield_per(chunk_size):
+        if first_id is None:
+            first_id = order_id
+        last_id = order_id
+        num_of_ids += 1
+        if num_of_ids == chunk_size:
+            yield first_id, last_id
+            first_id = None
+            num_of_ids = 0
+    if first_id is not None:
+        yield first_id, last_id
+
+def _init_worker():
+    # Connections inherited from the parent process must not be shared
+    db.engine.dispose()
+
+def _revalidate_range(args):
+    """Revalidate the orders of one id range and write back the changed
+    ones with their rollup changes, in one transaction. Return the range
+    with the number of checked and changed orders.
+    """
+    first_id, last_id, dry_run = args
+    # The rows stay locked until the commit, so that the rollup changes
+    # are computed from the values being replaced
+    query = db.session.query(Order.id, Order.name_column, Order.email_column,
+        Order.state_column, Order.zipcode_column, Order.birthday_column,
+        Order.valid, Order.validation_failure)\
+        .filter(Order.id.between(first_id, last_id))
+    if not dry_run:
+        query = query.with_for_update()
+    rows = query.all()
+    validated = BatchOrderValidator().validate({
+        'id': [row[0] for row in rows],
+        'name': [row[1] for row in rows],
+        'email': [row[2] for row in rows],
+        'state': [row[3] for row in rows],
+        'zipcode': [row[4] for row in rows],
+        'birthday': [row[5] for row in rows]})
+    updates = []
+    removed_rows = []
+    added_rows = []
+    for i, row in enumerate(rows):
+        valid = validated['valid'][i]
+        validation_failure = validated['validation_failure'][i]
+        old_failure = row[7] or {}
+        if 'birtday_validation' in old_failure and row[5] is None:
+            # The unparseable raw birthday was never stored, keep its error
+            validation_failure = dict(validation_failure or {})
+            validation_failure['birtday_validation'] =\
+                old_failure['birtday_validation']
+            valid = False
+        if valid != row[6] or validation_failure != row[7]:
+            updates.append({'id': row[0], 'valid': valid,
+                'validation_failure': validation_failure})
+            removed_rows.append((row[3], row[6], row[7]))
+            added_rows.append((row[3], valid, validation_failure))
+    if updates and not dry_run:
+        db.session.bulk_update_mappings(Order, updates)
+        update_rollups(removed_rows, added_rows)
+        db.session.commit()
+    db.session.remove()
+    return first_id, last_id, len(rows), len(updates)
+
+def revalidate_orders(chunk_size=10000, processes=None, dry_run=False,
+    state_file=None):
+    """Recompute the valid/validation_failure columns of all orders in id
+    range chunks spread over a pool of processes.
+
+    When a state file is given, the last completed id is recorded in it
+    after every chunk and a later run resumes after that id.
+    """
+
+    revalidated_data = {'orders': 0, 'changed': 0}
+
+    after_id = None
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            after_id = json.load(f)['last_id']
+        print('Resuming after order id=%d' % after_id)
+
+    id_ranges = [(first_id, last_id, dry_run) for first_id, last_id in
+        _iter_id_ranges(chunk_size, after_id)]
+    db.session.remove()
+
+    start_time = time.time()
+    pool = Pool(processes, initializer=_init_worker)
+    try:
+        # Results come back in range order, so the checkpoint is contiguous
+        for num_of_chunks, (first_id, last_id, checked, changed) in\
+            enumerate(pool.imap(_revalidate_range, id_ranges), 1):
+            revalidated_data['orders'] += checked
+            revalidated_data['changed'] += changed
+            if state_file and not dry_run:
+                with open(state_file, 'w') as f:
+                    json.dump({'last_id': last_id}, f)
+            elapsed = time.time() - start_time
+            print('[%d/%d] ids %d-%d: %d checked, %d changed (%.0f orders/s)' %
+                (num_of_chunks, len(id_ranges), first_id, last_id, checked,
+                changed, revalidated_data['orders'] / max(elapsed, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
+
+    if not dry_run:
+        Order._notify_write(None)
+        if state_file and os.path.exists(state_file):
+            os.remove(state_file)
+    return revalidated_data
@@ -0,0 +1,66 @@
+"""
+    acmewines.utils.serve
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    This is a module that runs the application under gunicorn, with
+    several worker processes serving requests from a pool of threads each
+"""
+
+import multiprocessing
+
+from acmewines import app, db
+from acmewines.tasks import MemoryJobStore, task_queue
+
+
+def _post_fork(server, worker):
+    # The connections opened before forking must not be shared
+    db.engine.dispose()
+    db.router.dispose()
+
+def _check_admission_limits(threads):
+    # A request holds its thread while it waits in the queue, so limited
+    # routes whose limits and queues add up to every thread can starve the
+    # others of one
+    controller = app.extensions['admission']
+    limiters = controller.limiters()
+    num_of_slots = sum(limiter.limit + limiter.queue_size
+        for _, limiter in limiters)
+    if limiters and num_of_slots >= threads:
+        raise SystemExit('The admission limits and queues of every route ' +
+            '(%d in all) must stay below the %d threads of a worker, ' %
+            (num_of_slots, threads) + 'lower ADMISSION_LIMITS and ' +
+            'ADMISSION_QUEUE_SIZE or serve with more threads')
+
+def serve(host='0.0.0.0', port=8000, workers=None, threads=16,
+    worker_class='gthread', timeout=30, backlog=2048):
+    """Serve the application until interrupted. The workers default to
+    twice the number of CPUs plus one.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit('Serving requires gunicorn, install it with ' +
+            '"pip install -r requirements.txt"')
+
+    workers = workers or multiprocessing.cpu_count() * 2 + 1
+    if workers > 1 and isinstance(task_queue.store, MemoryJobStore):
+        raise SystemExit('The job statuses kept in memory are not shared ' +
+            'by the workers, set TASK_STORE_PATH or serve with one worker')
+
+    if worker_class == 'gthread':
+        _check_admission_limits(threads)
+
+    options = {'bind': '%s:%d' % (host, port), 'workers': workers,
+        'threads': threads, 'worker_class': worker_class,
+        'timeout': timeout, 'backlog': backlog, 'post_fork': _post_fork}
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
@@ -0,0 +1,262 @@
+"""
+    acmewines.validators
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module compiles the order validation rules into a ruleset,
+    reloaded when their file changes, and validates orders in batches,
+    column by column, applying the same rules as the setters of the Order
+    model without creating one ORM object per order.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+from datetime import datetime, date
+
+from acmewines import app
+from acmewines.configs import validation
+from acmewines.emails import email_verifier
+from acmewines.utils.lru import LRUCache
+
+
+def _age_cutoff(today, min_age):
+    """Get the latest birthday allowed to order on the given day"""
+    try:
+        return today.replace(year=today.year - min_age)
+    except ValueError:
+        # Today is Feb 29 and the cutoff year is not a leap year
+        return today.replace(year=today.year - min_age, day=28)
+
+
+class ValidationRuleset(object):
+    """ Hold the validation rules compiled once: frozensets of states, the
+    compiled zipcode pattern, the age cutoff of the day and the memoized
+    state and zipcode verdicts. A verdict is None for a valid value, or
+    else the dict of its failures, which must not be modified.
+    """
+
+    def __init__(self, rules, version=None, memo_size=10000):
+        self.version = version
+        self.required_fields = tuple(rules['required_fields'])
+        self.states = frozenset(rules['states'])
+        self.states_not_allowed = frozenset(rules['states_not_allowed'])
+        self.zipcode_regex = re.compile(rules['zipcode_pattern'])
+        self.zipcode_max_digit_sum = rules['zipcode_max_digit_sum']
+        self.birthday_format = rules['birthday_format']
+        self.min_age = rules['min_age']
+        self._cutoff = (None, None)
+        self._state_verdicts = LRUCache(memo_size)
+        self._zipcode_verdicts = LRUCache(memo_size)
+
+    @classmethod
+    def from_pyfile(cls, path, memo_size=10000):
+        """Build the ruleset of a rules file, such as the one of
+        acmewines.configs.validation, versioned by its content.
+        """
+        with open(path, 'rb') as f:
+            source = f.read()
+        rules = {}
+        exec(compile(source, path, 'exec'), rules)
+        return cls(rules, version=hashlib.sha1(source).hexdigest()[:12],
+            memo_size=memo_size)
+
+    def age_cutoff(self):
+        """Get the latest birthday allowed to order today"""
+        today = date.today()
+        day, cutoff = self._cutoff
+        if day != today:
+            cutoff = _age_cutoff(today, self.min_age)
+            self._cutoff = (today, cutoff)
+        return cutoff
+
+    def check_state(self, value):
+        verdict = self._state_verdicts.get(value)
+        if verdict is None:
+            verdict = (self._check_state(value),)
+            self._state_verdicts.set(value, verdict)
+        return verdict[0]
+
+    def _check_state(self, value):
+        if value not in self.states:
+            return {'state_validation': value +
+                ' is not a valid/allowed U.S. state abbreviation'}
+        elif value in self.states_not_allowed:
+            return {'allowed_states': "We don't ship to " + value}
+        return None
+
+    def check_zipcode(self, value):
+        verdict = self._zipcode_verdicts.get(value)
+        if verdict is None:
+            verdict = (self._check_zipcode(value),)
+            self._zipcode_verdicts.set(value, verdict)
+        return verdict[0]
+
+    def _check_zipcode(self, value):
+        if not self.zipcode_regex.match(value):
+            return {'zipcode_validation': value + ' is not a valid' +
+                '5-digit (e.g., 00000) or 9-digit (e.g., 00000-0000) zipcode'}
+        if sum(map(int, value.replace('-', ''))) > self.zipcode_max_digit_sum:
+            return {'zipcode_digit_sum': "The sum of zipcode's digits " +
+                'is too large (> %d)' % self.zipcode_max_digit_sum}
+        return None
+
+
+class RulesetLoader(object):
+    """ Provide the current ruleset of a rules file, rebuilt when the
+    file changes (checked at most every reload_seconds, never when None),
+    so that the running workers pick up the new rules.
+    """
+
+    def __init__(self, path, reload_seconds=5, memo_size=10000):
+        self._path = path
+        self._reload_seconds = reload_seconds
+        self._memo_size = memo_size
+        self._ruleset = None
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get the current ruleset"""
+        if self._ruleset is not None and (self._reload_seconds is None or
+            time.time() - self._checked_at < self._reload_seconds):
+            return self._ruleset
+        with self._lock:
+            self._checked_at = time.time()
+            mtime = os.path.getmtime(self._path)
+            if self._ruleset is None or mtime != self._mtime:
+                self._load(mtime)
+        return self._ruleset
+
+    def reload(self):
+        """Rebuild the ruleset from the file now"""
+        with self._lock:
+            self._checked_at = time.time()
+            self._load(os.path.getmtime(self._path))
+        return self._ruleset
+
+    def _load(self, mtime):
+        try:
+            self._ruleset = ValidationRuleset.from_pyfile(self._path,
+                self._memo_size)
+        except Exception:
+            if self._ruleset is None:
+                raise
+            # Keep validating with the previous rules
+            app.logger.exception('The validation rules of %s could not ' %
+                self._path + 'be loaded')
+        self._mtime = mtime
+
+
+# The rules of acmewines.configs.validation, unless another file is set
+validation_rules = RulesetLoader(
+    app.config.get('VALIDATION_RULES_PATH') or
+        os.path.splitext(validation.__file__)[0] + '.py',
+    reload_seconds=app.config.get('VALIDATION_RELOAD_SECONDS', 5),
+    memo_size=app.config.get('VALIDATION_MEMO_SIZE', 10000))
+
+
+class BatchOrderValidator(object):
+    """ Validate columns of raw order fields in one pass. """
+
+    def __init__(self):
+        self._ruleset = validation_rules.get()
+
+    def validate(self, columns):
+        """Validate a batch given as a dict mapping the field names to
+        equally long lists of raw values (None for a missing value).
+
+        Return a dict with the normalized 'name', 'email', 'state',
+        'zipcode' and parsed 'birthday' columns (which may also hold
+        already parsed dates) plus the 'valid' and
+        'validation_failure' columns, as the Order model would set them.
+        """
+        num_of_rows = len(columns['id'])
+        normalized = {'id': columns['id']}
+        failures = [{} for _ in range(num_of_rows)]
+
+        normalized['name'] = self._normalize(columns.get('name'),
+            num_of_rows, lambda value: value.strip())
+        normalized['email'] = self._normalize(columns.get('email'),
+            num_of_rows, lambda value: value.strip().lower())
+        normalized['state'] = self._normalize(columns.get('state'),
+            num_of_rows, lambda value: value.strip().upper())
+        normalized['zipcode'] = self._normalize(columns.get('zipcode'),
+            num_of_rows, lambda value: value.strip())
+
+        email_verdicts = email_verifier.verify_many(value
+            for value in normalized['email'] if value is not None)
+        self._check_column(normalized['email'], failures,
+            lambda value: self._check_email(email_verdicts[value]))
+        self._check_column(normalized['state'], failures,
+            self._ruleset.check_state)
+        self._check_column(normalized['zipcode'], failures,
+            self._ruleset.check_zipcode)
+        normalized['birthday'] = self._parse_birthdays(
+            self._normalize(columns.get('birthday'), num_of_rows,
+            lambda value: value if isinstance(value, date) else value.strip()),
+            failures)
+
+        for field in self._ruleset.required_fields:
+            error = 'The %s is missing' % field
+            for row, value in enumerate(normalized[field]):
+                if value is None:
+                    failures[row]['required_' + field] = error
+
+        normalized['validation_failure'] = [failure or None
+            for failure in failures]
+        normalized['valid'] = [not failure for failure in failures]
+        return normalized
+
+    def _normalize(self, values, num_of_rows, normalizer):
+        if values is None:
+            return [None] * num_of_rows
+        # Empty values are left unset, as Order.__init__ skips them
+        return [normalizer(value) if value else None for value in values]
+
+    def _check_column(self, values, failures, check):
+        verdicts = {}
+        for row, value in enumerate(values):
+            if value is None:
+                continue
+            if value not in verdicts:
+                verdicts[value] = check(value)
+            if verdicts[value]:
+                failures[row].update(verdicts[value])
+
+    def _check_email(self, verdict):
+        if not verdict:
+            return {'email_validation': 'The email address is not valid'}
+        return None
+
+    def _parse_birthdays(self, values, failures):
+        cutoff = self._ruleset.age_cutoff()
+        parsed_values = {}
+        birthdays = []
+        for row, value in enumerate(values):
+            if value is None:
+                birthdays.append(None)
+                continue
+            if isinstance(value, date):
+                birthday = value
+            else:
+                if value not in parsed_values:
+                    try:
+                        parsed_values[value] = datetime.strptime(value,
+                            self._ruleset.birthday_format).date()
+                    except ValueError:
+                        parsed_values[value] = None
+                birthday = parsed_values[value]
+            birthdays.append(birthday)
+            if birthday is None:
+                # The key matches the one set by the Order model
+                failures[row]['birtday_validation'] =\
+                    '%s is not a valid birthday format: %s' %\
+                    (value, self._ruleset.birthday_format)
+            elif birthday > cutoff:
+                failures[row]['age_restriction'] =\
+                    'You must be %d or older to order' % self._ruleset.min_age
+        return birthdays
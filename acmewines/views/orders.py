@@ -1,19 +1,198 @@
-from flask import Blueprint, request, jsonify
+import hashlib
 
+from flask import (Blueprint, Response, request, jsonify, json,
+    stream_with_context, url_for)
+
+from acmewines import app, db
+from acmewines.cache import order_list_cache, order_index
+from acmewines.instrumentation import timed
 from acmewines.models import Order
-from acmewines.tasks import OrderFilterTask
+from acmewines.serializers import (json_serializer, make_response,
+    negotiate, render)
+from acmewines.tasks import (OrderFilterTask, OrderStatsTask, BulkImportTask,
+    read_from_replica)
+from acmewines.utils.export import (export_formats, iter_export_chunks,
+    gzip_chunks)
 
 mod = Blueprint('orders', __name__, url_prefix='/orders')
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def _stream_mimetype():
+    if request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        return NDJSON_MIMETYPE
+    elif request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return 'application/json'
+    else:
+        return None
+
+def _stream_json(order_filter_task):
+    yield '{"effect_filters": %s, "warnings": %s, "results": [' %\
+        (json.dumps(order_filter_task.effect_filter_params),
+        json.dumps(order_filter_task.warnings))
+    num_of_orders = 0
+    for order in order_filter_task.iterate(as_dicts=True):
+        if num_of_orders:
+            yield ', '
+        yield json.dumps(order)
+        num_of_orders += 1
+    # The count is only known once every row has been sent
+    yield '], "num_of_orders": %d, "next_cursor": %s}' %\
+        (num_of_orders, json.dumps(order_filter_task.next_cursor))
+
+def _stream_ndjson(order_filter_task):
+    yield json.dumps({'effect_filters': order_filter_task.effect_filter_params,
+        'warnings': order_filter_task.warnings}) + '\n'
+    num_of_orders = 0
+    for order in order_filter_task.iterate(as_dicts=True):
+        yield json.dumps(order) + '\n'
+        num_of_orders += 1
+    yield json.dumps({'num_of_orders': num_of_orders,
+        'next_cursor': order_filter_task.next_cursor}) + '\n'
+
+def _as_utc(value):
+    # The timestamps are time zone aware on PostgreSQL and naive UTC on
+    # SQLite, compare them as naive UTC
+    if value is not None and value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        # HTTP dates only carry whole seconds
+        return last_modified.replace(microsecond=0) <=\
+            request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def _conditional_response(etag, last_modified, make_response):
+    """Answer 304 when the client's copy is fresh, or else build the
+    response and tag it with the validators.
+    """
+    last_modified = _as_utc(last_modified)
+    if _not_modified(etag, last_modified):
+        # The validators depend on the negotiated format as the body does
+        response = Response(status=304)
+        response.vary.add('Accept')
+    else:
+        response = make_response()
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
 @mod.route('/')
 def index():
     url_params = request.args
-    order_filter_task = OrderFilterTask(url_params)
+    try:
+        order_filter_task = OrderFilterTask(url_params)
+    except ValueError as error:
+        return jsonify({'bad_request': str(error)}), 400
+    stream_mimetype = _stream_mimetype()
+    if stream_mimetype == NDJSON_MIMETYPE:
+        return Response(stream_with_context(_stream_ndjson(order_filter_task)),
+            mimetype=NDJSON_MIMETYPE)
+    elif stream_mimetype:
+        return Response(stream_with_context(_stream_json(order_filter_task)),
+            mimetype=stream_mimetype)
     effect_filters = order_filter_task.effect_filter_params
-    filtered_orders = [order.toDict() for order in order_filter_task.run()]
-    return jsonify(effect_filters = order_filter_task.effect_filter_params, 
-        num_of_orders = len(filtered_orders),
-        results = filtered_orders)
+    serializer = negotiate()
+    # The total number of matching orders is only counted on request
+    count_mode = request.args.get('count', '').lower()
+    if count_mode not in ('exact', 'estimate'):
+        count_mode = None
+    cache_key = order_list_cache.make_key([serializer.name, effect_filters,
+        order_filter_task.warnings, count_mode])
+    # A cached entry is only reachable until the next order write, so its
+    # validators and total are still current and the count and freshness
+    # queries can be skipped
+    cached_entry = order_list_cache.get(cache_key)
+    if cached_entry is not None:
+        etag, last_modified, total_num_of_orders, body = cached_entry
+        return _conditional_response(etag, last_modified,
+            lambda: make_response(body, serializer))
+    with timed('count'):
+        if count_mode:
+            total_num_of_orders = order_filter_task.count(
+                estimate=count_mode == 'estimate')
+        else:
+            total_num_of_orders = None
+    with timed('freshness'):
+        last_modified, num_of_orders = order_filter_task.freshness()
+    etag = hashlib.sha1(json.dumps([effect_filters, order_filter_task.warnings,
+        last_modified and last_modified.isoformat(), num_of_orders,
+        total_num_of_orders, serializer.name],
+        sort_keys=True).encode('utf-8')).hexdigest()
+    return _conditional_response(etag, last_modified,
+        lambda: _list_orders(order_filter_task, total_num_of_orders,
+        serializer, cache_key, etag, last_modified))
+
+def _list_orders(order_filter_task, total_num_of_orders, serializer,
+    cache_key, etag, last_modified):
+    with timed('query'):
+        filtered_orders = order_filter_task.run(as_dicts=True)
+    with timed('serialize'):
+        response = render({
+            'effect_filters': order_filter_task.effect_filter_params,
+            'warnings': order_filter_task.warnings,
+            'num_of_orders': len(filtered_orders),
+            'total_num_of_orders': total_num_of_orders,
+            'next_cursor': order_filter_task.next_cursor,
+            'results': filtered_orders}, serializer)
+    # The response is cached until the next write, so it must not come
+    # from a replica which may have yet to replay the last one
+    if not db.router.may_lag(order_list_cache.invalidated_at):
+        order_list_cache.set(cache_key, (etag, last_modified,
+            total_num_of_orders, response.get_data()))
+    return response
+
+@mod.route('/export')
+def export():
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in export_formats:
+        return jsonify({'bad_request': 'The export format must be one of: ' +\
+            ', '.join(sorted(export_formats))}), 400
+    try:
+        order_filter_task = OrderFilterTask(request.args)
+    except ValueError as error:
+        return jsonify({'bad_request': str(error)}), 400
+    chunks = iter_export_chunks(order_filter_task, export_format)
+    headers = {'Content-Disposition':
+        'attachment; filename=orders.' + export_format}
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks),
+        mimetype=export_formats[export_format], headers=headers)
+
+@mod.route('/stats')
+def stats():
+    order_stats_task = OrderStatsTask(request.args)
+    return jsonify(effect_filters = order_stats_task.effect_filter_params,
+        group_by = order_stats_task.group_by,
+        num_of_orders = order_stats_task.count(),
+        groups = order_stats_task.run())
+
+@mod.route('/cache_stats')
+def cache_stats():
+    return jsonify(order_list_cache.stats())
+
+@mod.route('/bulk', methods=['POST'])
+def bulk_create_orders():
+    records = request.get_json(silent=True)
+    if isinstance(records, dict):
+        records = records.get('orders')
+    if not isinstance(records, list):
+        return jsonify({'bad_request': 'The request body must be a JSON ' +\
+            'list of orders or an object with an "orders" list'}), 400
+    bulk_import_task = BulkImportTask(records)
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        job_id = bulk_import_task.submit()
+        job_url = url_for('tasks.show_job', job_id=job_id)
+        return jsonify(job_id = job_id, status_url = job_url), 202,\
+            {'Location': job_url}
+    return jsonify(bulk_import_task.run())
 
 @mod.route('/create', methods=['GET', 'POST'])
 def create_order():
@@ -22,11 +201,76 @@ def create_order():
     return render_template('creat_order.html', error=error)
         
 
+def _load_orders(ids):
+    """Read the orders into the order index, with chunked IN queries, and
+    return their entries by id.
+    """
+    version = order_index.version
+    chunk_size = app.config.get('ORDERS_BATCH_CHUNK_SIZE', 500)
+    entries = dict((id, (None, None)) for id in ids)
+    query = Order.query.with_entities(*(Order.visible_columns() +
+        [Order.updated_at]))
+    for i in range(0, len(ids), chunk_size):
+        with timed('query'):
+            rows = read_from_replica(
+                query.filter(Order.id.in_(ids[i:i + chunk_size])).all)
+        with timed('serialize'):
+            for row in rows:
+                entries[row[0]] = (json_serializer.dumps(
+                    Order.row_to_dict(row[:-1])), row[-1])
+    # The index outlives the replica lag, so it is only filled once the
+    # replicas may have replayed the last write
+    if not db.router.may_lag(order_index.dropped_at):
+        for id, (body, last_modified) in entries.items():
+            order_index.set(id, body, last_modified, version)
+    return entries
+
+def _not_found_message(id):
+    return {'not_found': 'The order of id=' + str(id) + ' does not exist'}
+
 @mod.route('/<int:id>')
 def show_order(id):
-    retrieved_order = Order.query.get(id)
-    if retrieved_order:
-        return jsonify(retrieved_order.toDict())
+    serializer = negotiate()
+    entry = order_index.get(id)
+    body, last_modified = entry if entry is not None else\
+        _load_orders([id])[id]
+    if body is not None:
+        etag = '%d-%s-%s' % (id, last_modified and last_modified.isoformat(),
+            serializer.name)
+        return _conditional_response(etag, last_modified,
+            lambda: make_response(serializer.recode(body), serializer))
+    else:
+        return render(_not_found_message(id), serializer)
+
+@mod.route('/batch', methods=['GET', 'POST'])
+def show_orders():
+    if request.method == 'POST':
+        ids = request.get_json(silent=True)
+        if isinstance(ids, dict):
+            ids = ids.get('ids')
     else:
-        return jsonify({'not_found': 'The order of id=' + str(id) +\
-            ' does not exist'})
+        ids = request.args.get('ids', '').split(',')
+    try:
+        ids = [int(id) for id in ids]
+    except (TypeError, ValueError):
+        return jsonify({'bad_request': 'The ids must be a comma-separated ' +\
+            'list of order ids, or a JSON list of them (or an object with ' +\
+            'an "ids" list) in the POST body'}), 400
+    max_ids = app.config.get('ORDERS_BATCH_MAX_IDS', 1000)
+    if len(ids) > max_ids:
+        return jsonify({'bad_request': 'At most %d ids can be looked up ' %\
+            max_ids + 'per request'}), 400
+    entries = {}
+    for id in ids:
+        entries[id] = order_index.get(id)
+    missed_ids = [id for id, entry in entries.items() if entry is None]
+    if missed_ids:
+        entries.update(_load_orders(missed_ids))
+    # Join the pre-encoded orders, in the order of the request
+    results = []
+    for id in ids:
+        body = entries[id][0]
+        results.append(body if body is not None else
+            json_serializer.dumps(_not_found_message(id)))
+    return render({'num_of_orders': sum(entries[id][0] is not None
+        for id in ids)}, encoded_results=results)
@@ -0,0 +1,14 @@
+from flask import Blueprint, jsonify
+
+from acmewines.tasks import task_queue
+
+mod = Blueprint('tasks', __name__, url_prefix='/tasks')
+
+@mod.route('/<job_id>')
+def show_job(job_id):
+    job = task_queue.store.get(job_id)
+    if job:
+        return jsonify(job)
+    else:
+        return jsonify({'not_found': 'The job of id=' + job_id +\
+            ' does not exist'})
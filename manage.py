@@ -5,13 +5,22 @@
     This script provides ready-to-use commands for
     * database migration
     * running local development server
+    * serving the application with several workers and load testing it
+    * seeding, revalidating and exporting orders
+    * benchmarking the orders API and inspecting its slow queries
 """
 
+import json
+import time
+
 from flask_script import Manager, Server, Shell
+from werkzeug.urls import url_decode
 from flask_migrate import Migrate, MigrateCommand, upgrade, downgrade
 
 from acmewines import app, db
-from acmewines.utils.populate import seed_test_data
+from acmewines.utils.populate import seed_test_data, seed_bulk_data
+from acmewines.utils.revalidate import revalidate_orders
+from acmewines.utils.export import export_orders
 
 migrate = Migrate(app, db)
 
@@ -25,6 +34,29 @@ manager.add_command('db_migration', MigrateCommand)
 # Run local server
 manager.add_command('runserver', Server('localhost', port=8888))
 
+@manager.option('-h', '--host', dest='host', default='0.0.0.0')
+@manager.option('-p', '--port', dest='port', type=int, default=8000)
+@manager.option('-w', '--workers', dest='workers', type=int, default=0)
+@manager.option('-t', '--threads', dest='threads', type=int, default=16)
+@manager.option('-k', '--worker_class', dest='worker_class',
+    default='gthread')
+@manager.option('--timeout', dest='timeout', type=int, default=30)
+def serve(host, port, workers, threads, worker_class, timeout):
+    """Serve the application under gunicorn.
+    Use the '-h' or '--host' and '-p' or '--port' options for the address.
+    Use the '-w' or '--workers' option for the worker processes (defaults
+    to twice the number of CPUs plus one) and the '-t' or '--threads'
+    option for the threads per worker, which must outnumber the admission
+    limit plus the queue of every route.
+    Use the '-k' or '--worker_class' option for another gunicorn worker
+    class (e.g. gevent) and the '--timeout' option for the seconds after
+    which a silent worker gets restarted.
+    """
+
+    from acmewines.utils.serve import serve
+    serve(host=host, port=port, workers=workers or None, threads=threads,
+        worker_class=worker_class, timeout=timeout)
+
 # Interactive project shell
 def _make_shell_context():
    return dict(app=app, db=db)
@@ -44,10 +76,14 @@ def cleanupdb():
     upgrade()
 
 @manager.command
-def seeddb(initdb=False, cleanupdb=False, orders=20):
+def seeddb(initdb=False, cleanupdb=False, orders=20, fast=False,
+    processes=0, seed=0):
     """Seed fake data into the database.
     To create new database use the '-i' or '--initdb' option.
     To clear up the existing database use the '-c' or '--cleanupdb' option.
+    To seed large data sets for load tests use the '-f' or '--fast' option,
+    with '-p' or '--processes' for the worker processes and '-s' or
+    '--seed' for a reproducible data set.
     """
 
     if initdb:
@@ -59,8 +95,136 @@ def seeddb(initdb=False, cleanupdb=False, orders=20):
         downgrade(revision='base')
         upgrade()
 
-    seeded_data = seed_test_data(orders=int(orders))
+    if fast:
+        seeded_data = seed_bulk_data(orders=int(orders), seed=int(seed),
+            processes=int(processes) or None)
+    else:
+        seeded_data = seed_test_data(orders=int(orders))
     print("Created and saved test data into database: %r" % seeded_data)
 
+@manager.command
+def revalidate(chunk_size=10000, processes=0, dry_run=False,
+    state_file='.revalidate_state'):
+    """Recompute the validation state of the stored orders.
+    Use the '-c' or '--chunk_size' option to set the orders per chunk.
+    Use the '-p' or '--processes' option to set the worker processes
+    (defaults to the number of CPUs).
+    Use the '-d' or '--dry_run' option to only report the changes.
+    An interrupted run resumes from the '-s' or '--state_file' file.
+    """
+
+    revalidated_data = revalidate_orders(chunk_size=int(chunk_size),
+        processes=int(processes) or None, dry_run=dry_run,
+        state_file=state_file)
+    print("Revalidated orders in database: %r" % revalidated_data)
+
+@manager.option('-f', '--format', dest='export_format', default='csv')
+@manager.option('-o', '--output', dest='output', default='orders.csv.gz')
+@manager.option('-q', '--query', dest='query', default='')
+def export(export_format, output, query):
+    """Export the orders into a file.
+    Use the '-f' or '--format' option to choose csv or ndjson.
+    Use the '-o' or '--output' option to set the file, which is gzipped
+    when its name ends with '.gz'.
+    Use the '-q' or '--query' option to filter the orders with the
+    parameters of GET /orders (e.g. 'state_equals=CA&valid=1').
+    """
+
+    from acmewines.tasks import OrderFilterTask
+    try:
+        order_filter_task = OrderFilterTask(url_decode(query))
+    except ValueError as error:
+        raise SystemExit(str(error))
+    with open(output, 'wb') as f:
+        num_of_bytes = export_orders(order_filter_task, export_format, f,
+            compress=output.endswith('.gz'))
+    print("Exported orders into %s (%d bytes)" % (output, num_of_bytes))
+
+@manager.command
+def benchmark(sizes='1000', database='', repeat=5, output='benchmark.json',
+    baseline='', threshold=0.2):
+    """Benchmark the orders API on seeded data sets.
+    Use the '-s' or '--sizes' option for the comma separated data set sizes.
+    Use the '-d' or '--database' option for the benchmark database URI,
+    which is wiped and must not be the application database (benchmark.db
+    in the project directory by default).
+    Use the '-r' or '--repeat' option for the runs per case.
+    The results are written as JSON to the '-o' or '--output' file. With
+    the '-b' or '--baseline' option they are compared to a previous run
+    and the command fails on medians slower by more than the '-t' or
+    '--threshold' ratio.
+    """
+
+    from acmewines.utils.benchmark import (DEFAULT_DATABASE_URI,
+        run_benchmarks, save_report, load_report, find_regressions)
+    database = database or DEFAULT_DATABASE_URI
+    if database == app.config['SQLALCHEMY_DATABASE_URI']:
+        raise SystemExit('The benchmark database must not be the ' +
+            'application database')
+    report = run_benchmarks(sizes=[int(size) for size in sizes.split(',')],
+        database_uri=database, repeat=int(repeat))
+    save_report(report, output)
+    print("Saved benchmark results into %s" % output)
+    if baseline:
+        regressions = find_regressions(report, load_report(baseline),
+            threshold=float(threshold))
+        for regression in regressions:
+            print("Regression in %(case)s: %(baseline_ms).3f ms -> " %
+                regression + "%.3f ms" % regression['median_ms'])
+        if regressions:
+            raise SystemExit(1)
+
+@manager.command
+def slowqueries(shapes=False, limit=20):
+    """Show the recorded slow order queries, the latest first.
+    Use the '-s' or '--shapes' option to aggregate them by filter shape.
+    Use the '-l' or '--limit' option to set the number of entries shown.
+    """
+
+    from acmewines.slowqueries import slow_query_log, plan_summary
+    if not slow_query_log.path:
+        print("SLOW_QUERY_LOG_PATH is None, the slow queries of the " +
+            "server processes are only kept in their memory")
+        return
+    if shapes:
+        for shape in slow_query_log.shapes()[:int(limit)]:
+            print("%(shape)s: %(count)d queries, mean %(mean_ms).1f ms, " %
+                shape + "max %(max_ms).1f ms" % shape)
+        return
+    for record in reversed(slow_query_log.records()[-int(limit):]):
+        print("#%d %s %.1f ms %s" % (record['id'], time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(record['recorded_at'])),
+            record['duration_ms'], record['shape']))
+        print("  filters: %s" % json.dumps(record['filters'], sort_keys=True))
+        print("  sql: %s" % ' '.join(record['statement'].split()))
+        print("  parameters: %r" % (record['parameters'],))
+        print("  plan: %s" % plan_summary(record['plan']))
+
+@manager.command
+def loadtest(url='http://localhost:8000', paths='/orders/', concurrency=50,
+    duration=30, output=''):
+    """Load a running server and report the latency percentiles per
+    response status.
+    Use the '-u' or '--url' option for the base URL of the server.
+    Use the '-p' or '--paths' option for the comma separated paths
+    requested in turn (e.g. '/orders/,/orders/?state_equals=CA').
+    Use the '-c' or '--concurrency' option for the concurrent clients and
+    the '-d' or '--duration' option for the seconds to run.
+    The report is also written as JSON to the '-o' or '--output' file.
+    """
+
+    from acmewines.utils.loadtest import run_load_test
+    report = run_load_test(url, paths=paths.split(','),
+        concurrency=int(concurrency), duration=float(duration))
+    print("%(requests)d requests in %(duration).1f s " % report +
+        "(%(requests_per_second).1f/s) from %(concurrency)d clients" % report)
+    for status, timings in sorted(report['statuses'].items()):
+        print("%s: %d requests, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, " %
+            (status, timings['count'], timings['p50_ms'], timings['p95_ms'],
+            timings['p99_ms']) + "max %.1f ms" % timings['max_ms'])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
 if __name__ == '__main__':
     manager.run()
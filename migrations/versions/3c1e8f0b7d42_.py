@@ -0,0 +1,33 @@
+"""store the order timestamps with their time zone
+
+Revision ID: 3c1e8f0b7d42
+Revises: a27b585057d7
+Create Date: 2026-10-18 16:42:08.112874
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1e8f0b7d42'
+down_revision = 'a27b585057d7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The existing values are read in the time zone of the server
+    for column_name in ('created_at', 'updated_at'):
+        op.alter_column('orders', column_name,
+            type_=sa.DateTime(timezone=True),
+            existing_type=sa.DateTime(),
+            existing_server_default=sa.text(u'NOW()'),
+            existing_nullable=True)
+
+
+def downgrade():
+    for column_name in ('created_at', 'updated_at'):
+        op.alter_column('orders', column_name,
+            type_=sa.DateTime(),
+            existing_type=sa.DateTime(timezone=True),
+            existing_server_default=sa.text(u'NOW()'),
+            existing_nullable=True)
@@ -0,0 +1,25 @@
+"""add indexes matching the field match filters
+
+Revision ID: 669420a14b02
+Revises: 6da993e1a732
+Create Date: 2026-10-18 10:47:05.218336
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '669420a14b02'
+down_revision = '6da993e1a732'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_orders_name_lower', 'orders', [sa.text('lower(name)')],
+        unique=False)
+    op.create_index('ix_orders_zipcode', 'orders', ['zipcode'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_orders_zipcode', table_name='orders')
+    op.drop_index('ix_orders_name_lower', table_name='orders')
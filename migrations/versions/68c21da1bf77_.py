@@ -0,0 +1,30 @@
+"""add order counts per state and validity
+
+Revision ID: 68c21da1bf77
+Revises: 669420a14b02
+Create Date: 2026-10-18 11:30:52.874210
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '68c21da1bf77'
+down_revision = '669420a14b02'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('order_counts',
+    sa.Column('state', sa.String(length=30), nullable=False),
+    sa.Column('valid', sa.Boolean(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('state', 'valid')
+    )
+    op.execute("INSERT INTO order_counts (state, valid, count) "
+        "SELECT coalesce(state, ''), valid, count(id) FROM orders "
+        "WHERE valid IS NOT NULL GROUP BY coalesce(state, ''), valid")
+
+
+def downgrade():
+    op.drop_table('order_counts')
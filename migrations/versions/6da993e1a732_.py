@@ -0,0 +1,31 @@
+"""add trigram indexes for partial match filters
+
+Revision ID: 6da993e1a732
+Revises: 058f3a1d6208
+Create Date: 2026-10-18 10:12:41.503517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6da993e1a732'
+down_revision = '058f3a1d6208'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_orders_name_trgm', 'orders', ['name'], unique=False,
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_orders_email_trgm', 'orders', ['email'], unique=False,
+        postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+    op.create_index('ix_orders_zipcode_trgm', 'orders', ['zipcode'],
+        unique=False, postgresql_using='gin',
+        postgresql_ops={'zipcode': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_orders_zipcode_trgm', table_name='orders')
+    op.drop_index('ix_orders_email_trgm', table_name='orders')
+    op.drop_index('ix_orders_name_trgm', table_name='orders')
@@ -0,0 +1,31 @@
+"""add order failure counts per state and failure key
+
+Revision ID: a27b585057d7
+Revises: 68c21da1bf77
+Create Date: 2026-10-18 12:05:17.390442
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a27b585057d7'
+down_revision = '68c21da1bf77'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('order_failure_counts',
+    sa.Column('state', sa.String(length=30), nullable=False),
+    sa.Column('failure_key', sa.String(length=64), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('state', 'failure_key')
+    )
+    op.execute("INSERT INTO order_failure_counts (state, failure_key, count) "
+        "SELECT coalesce(state, ''), failure_key, count(id) "
+        "FROM orders, json_object_keys(validation_failure) AS failure_key "
+        "WHERE valid = false GROUP BY coalesce(state, ''), failure_key")
+
+
+def downgrade():
+    op.drop_table('order_failure_counts')
@@ -0,0 +1,18 @@
+"""
+    config
+    ~~~~~~
+
+    This is the configuration of the tests, run against the database of
+    ACMEWINES_TEST_DATABASE_URI (an in-memory SQLite one when unset)
+"""
+
+import os
+
+DEBUG = False
+TESTING = True
+SQLALCHEMY_DATABASE_URI = os.environ.get('ACMEWINES_TEST_DATABASE_URI',
+    'sqlite://')
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Keep the job statuses and the slow queries of the tests in memory
+TASK_STORE_PATH = None
+SLOW_QUERY_LOG_PATH = None
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# Load the configuration of the tests rather than the one of the app
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(1, os.path.dirname(os.path.dirname(__file__)))
+
+from acmewines import app, db
+from acmewines.cache import order_index, order_list_cache
+
+
+@pytest.fixture
+def database():
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.commit()
+    db.create_all()
+    yield db
+    db.session.remove()
+    db.drop_all()
+    order_list_cache.invalidate()
+    order_index.invalidate()
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+@pytest.fixture
+def postgres(database):
+    if database.engine.dialect.name != 'postgresql':
+        pytest.skip('ACMEWINES_TEST_DATABASE_URI is not a PostgreSQL URI')
+    return database
+
+def make_record(id, **fields):
+    record = {'id': id, 'name': 'Jane Doe', 'email': 'jane@example.com',
+        'state': 'CA', 'zipcode': '12345', 'birthday': 'Jan 01, 1980'}
+    record.update(fields)
+    return record
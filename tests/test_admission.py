@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+
+from acmewines import app
+from acmewines.admission import AdmissionController, RouteLimiter
+from acmewines.tasks import OrderFilterTask
+from acmewines.utils.serve import _check_admission_limits
+
+
+def test_statement_timeout_lasts_for_the_transaction(postgres, monkeypatch):
+    monkeypatch.setitem(app.config, 'ORDERS_STATEMENT_TIMEOUT_MS', 1234)
+    list(OrderFilterTask().iterate())
+    assert postgres.session.execute('SHOW statement_timeout').scalar() ==\
+        '1234ms'
+    postgres.session.rollback()
+    assert postgres.session.execute('SHOW statement_timeout').scalar() !=\
+        '1234ms'
+
+def test_route_limiter_queues_then_turns_requests_away():
+    limiter = RouteLimiter(1, queue_size=1, queue_timeout=5)
+    assert limiter.acquire()
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(
+        limiter.acquire()))
+    waiting.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    # The queue is full
+    assert not limiter.acquire()
+    limiter.release()
+    waiting.join()
+    assert results == [True] and limiter.active == 1
+
+def test_route_limiter_gives_up_after_the_queue_timeout():
+    limiter = RouteLimiter(1, queue_size=1, queue_timeout=0.01)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.waiting == 0
+
+def test_serve_refuses_limits_which_every_thread_can_reach(monkeypatch):
+    monkeypatch.setitem(app.extensions, 'admission', AdmissionController(
+        limits={'orders.index': 8, 'orders.export': 2}, queue_size=2))
+    _check_admission_limits(16)
+    with pytest.raises(SystemExit):
+        _check_admission_limits(14)
@@ -0,0 +1,96 @@
+import time
+
+from flask import json
+
+from acmewines.cache import (DictCacheBackend, LRUCache, LocalPubSub,
+    OrderIndex, ResponseCache)
+from acmewines.tasks import OrderFilterTask
+
+from conftest import make_record
+
+
+def _import(client, records):
+    response = client.post('/orders/bulk', data=json.dumps(records),
+        content_type='application/json')
+    assert response.status_code == 200
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+def test_lru_cache_expires_its_entries(monkeypatch):
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=60)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 30)
+    assert (cache.get('a'), cache.get('b')) == (None, 2)
+
+def test_response_cache_generation_is_shared_through_the_backend():
+    backend = DictCacheBackend()
+    cache = ResponseCache('test', backend=backend)
+    other_cache = ResponseCache('test', backend=backend)
+    key = cache.make_key({'limit': 10})
+    cache.set(key, b'[]')
+    assert other_cache.get(other_cache.make_key({'limit': 10})) == b'[]'
+    other_cache.invalidate()
+    assert cache.make_key({'limit': 10}) != key
+    assert cache.get(cache.make_key({'limit': 10})) is None
+
+def test_order_list_answers_not_modified_to_its_etag(client):
+    _import(client, [make_record(1), make_record(2)])
+    response = client.get('/orders/')
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+    response = client.get('/orders/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+def test_cached_order_list_skips_the_count_and_freshness_queries(client,
+    monkeypatch):
+    _import(client, [make_record(1)])
+    response = client.get('/orders/?count=exact')
+    etag = response.headers['ETag']
+    body = response.get_data()
+
+    def query(self, *args, **kwargs):
+        raise AssertionError('The validators were not taken from the cache')
+    monkeypatch.setattr(OrderFilterTask, 'freshness', query)
+    monkeypatch.setattr(OrderFilterTask, 'count', query)
+    response = client.get('/orders/?count=exact')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == body
+    response = client.get('/orders/?count=exact',
+        headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+def test_order_write_changes_the_etag(client):
+    _import(client, [make_record(1)])
+    etag = client.get('/orders/').headers['ETag']
+    _import(client, [make_record(2)])
+    response = client.get('/orders/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert json.loads(response.get_data())['num_of_orders'] == 2
+
+def test_order_index_drops_the_orders_written_by_other_processes():
+    pubsub = LocalPubSub()
+    index, other_index = OrderIndex(pubsub=pubsub), OrderIndex(pubsub=pubsub)
+    for cache in (index, other_index):
+        cache.set(1, b'{}', None, cache.version)
+        cache.set(2, b'{}', None, cache.version)
+    index.invalidate([1])
+    assert index.get(1) is None and other_index.get(1) is None
+    assert index.get(2) is not None and other_index.get(2) is not None
+
+def test_order_index_skips_the_orders_loaded_before_a_write():
+    index = OrderIndex()
+    version = index.version
+    index.invalidate([1])
+    index.set(1, b'{}', None, version)
+    assert index.get(1) is None
@@ -0,0 +1,18 @@
+from acmewines.emails import EmailVerifier, StubResolver
+
+
+def test_verify_many_resolves_each_domain_once():
+    resolver = StubResolver({'example.com': ['mx.example.com']})
+    verifier = EmailVerifier(check_mx=True, resolver=resolver)
+    verdicts = verifier.verify_many(['jane@example.com', 'john@example.com',
+        'jane@example.org', 'not an email'])
+    assert verdicts == {'jane@example.com': True, 'john@example.com': True,
+        'jane@example.org': False, 'not an email': False}
+    assert sorted(resolver.lookups) == ['example.com', 'example.org']
+    verifier.verify('jim@example.com')
+    assert len(resolver.lookups) == 2
+
+def test_failed_lookup_gives_the_benefit_of_the_doubt():
+    resolver = StubResolver({'example.com': IOError('timed out')})
+    verifier = EmailVerifier(check_mx=True, resolver=resolver)
+    assert verifier.verify('jane@example.com')
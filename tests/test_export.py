@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+
+from flask import json
+
+from acmewines.models import Order
+from acmewines.tasks import OrderFilterTask
+from acmewines.utils.export import export_orders
+
+from conftest import make_record
+
+
+def _export(export_format, compress=False):
+    output = io.BytesIO()
+    export_orders(OrderFilterTask(), export_format, output, compress=compress)
+    data = output.getvalue()
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read() if compress\
+        else data
+
+def test_csv_export_encodes_non_ascii_names(database):
+    Order.save_many([make_record(1, name=u'Zo\xe9 M\xfcller')])
+    data = _export('csv', compress=True).decode('utf-8')
+    assert u'Zo\xe9 M\xfcller' in data.splitlines()[1]
+
+def test_ndjson_export_encodes_non_ascii_names(database):
+    Order.save_many([make_record(1, name=u'Zo\xe9 M\xfcller')])
+    order = json.loads(_export('ndjson').decode('utf-8').splitlines()[0])
+    assert order['name'] == u'Zo\xe9 M\xfcller'
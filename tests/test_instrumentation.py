@@ -0,0 +1,20 @@
+import pytest
+
+from flask import g
+from sqlalchemy.exc import DBAPIError
+
+from acmewines import app
+
+
+def test_failed_statements_leave_no_timing_behind(database):
+    with app.test_request_context():
+        g.stage_timings = {}
+        g.sql_count = 0
+        connection = database.session.connection()
+        with pytest.raises(DBAPIError):
+            connection.execute('SELECT * FROM no_such_table')
+        database.session.rollback()
+        connection = database.session.connection()
+        assert connection.execute('SELECT 1').scalar() == 1
+        assert g.sql_count == 1
+        assert 'query_start_time' not in connection.info
@@ -0,0 +1,88 @@
+from flask import json
+
+from conftest import make_record
+
+
+def test_bulk_import_reports_an_overlong_name(client):
+    records = [make_record(1), make_record(2, name='x' * 129),
+        make_record(3)]
+    response = client.post('/orders/bulk', data=json.dumps(records),
+        content_type='application/json')
+    result = json.loads(response.get_data())
+    assert response.status_code == 200
+    assert result['num_of_orders'] == 2
+    assert [error['index'] for error in result['errors']] == [1]
+    assert 'name' in result['errors'][0]['error']
+
+def test_bulk_import_reports_an_out_of_range_id(database):
+    from acmewines.models import Order
+    num_of_orders, errors = Order.save_many([make_record(2 ** 31),
+        make_record(1)])
+    assert num_of_orders == 1
+    assert errors == [{'index': 0, 'error': 'The id is out of range'}]
+
+def test_bulk_import_rejects_ids_which_are_not_integers(database):
+    from acmewines.models import Order
+    num_of_orders, errors = Order.save_many([make_record(1.7),
+        make_record(True), make_record('3'), make_record(4)])
+    assert num_of_orders == 2
+    assert [error['index'] for error in errors] == [0, 1]
+    assert sorted(order.id for order in Order.query) == [3, 4]
+
+def test_bulk_import_skips_the_listeners_without_new_orders(database,
+    monkeypatch):
+    from acmewines.models import Order
+    Order.save_many([make_record(1)])
+    writes = []
+    monkeypatch.setattr(Order, '_write_listeners', [writes.append])
+    num_of_orders, errors = Order.save_many([make_record(1)])
+    assert num_of_orders == 0
+    assert writes == []
+
+def test_rollups_count_the_imported_orders(database):
+    from acmewines.models import Order, OrderCount, OrderFailureCount
+    Order.save_many([make_record(1), make_record(2, state='NY'),
+        make_record(3, state='NJ'), make_record(4, state='NJ')])
+    assert OrderCount.total() == 4
+    assert OrderCount.total(state='NJ', valid=False) == 2
+    assert OrderFailureCount.total(state='NJ',
+        failure_key='allowed_states') == 2
+
+def test_rollup_increment_upserts_on_postgres(postgres):
+    from acmewines.models import OrderCount
+    OrderCount.increment({('CA', True): 2, ('NY', True): 1})
+    OrderCount.increment({('CA', True): 3, ('CA', False): 0})
+    assert OrderCount.total(state='CA') == 5
+    assert OrderCount.total() == 6
+
+def test_stats_break_down_the_valid_orders_by_default(client):
+    from acmewines.models import Order
+    Order.save_many([make_record(1), make_record(2, state='NJ')])
+    result = json.loads(client.get('/orders/stats').get_data())
+    assert result['group_by'] == ['state', 'valid']
+    assert result['groups'] == [
+        {'state': 'CA', 'valid': True, 'num_of_orders': 1},
+        {'state': 'NJ', 'valid': False, 'num_of_orders': 1}]
+    result = json.loads(client.get('/orders/stats?group_by=failure')
+        .get_data())
+    assert result['groups'] == [
+        {'failure': 'allowed_states', 'num_of_orders': 1}]
+
+def test_revalidation_moves_the_rollup_counts(database):
+    from acmewines.models import (Order, OrderCount, OrderFailureCount,
+        rebuild_rollups)
+    from acmewines.utils.revalidate import _revalidate_range
+    Order.save_many([make_record(1), make_record(2, state='NJ')])
+    # Stored under older rules, which allowed NJ and rejected CA
+    database.session.execute(Order.__table__.update().values(valid=True,
+        validation_failure=None).where(Order.id == 2))
+    database.session.execute(Order.__table__.update().values(valid=False,
+        validation_failure={'allowed_states': 'CA'}).where(Order.id == 1))
+    rebuild_rollups()
+    database.session.commit()
+    assert _revalidate_range((1, 2, False)) == (1, 2, 2, 2)
+    assert OrderCount.total(state='CA', valid=True) == 1
+    assert OrderCount.total(state='NJ', valid=False) == 1
+    assert OrderCount.total() == 2
+    assert OrderFailureCount.total(state='NJ',
+        failure_key='allowed_states') == 1
@@ -0,0 +1,53 @@
+import pytest
+
+from werkzeug.datastructures import MultiDict
+
+from acmewines.models import Order
+from acmewines.tasks import OrderFilterTask, compile_query
+
+
+def _seed(db, count=2000):
+    db.session.execute(Order.__table__.insert(), [{'id': i,
+        'name': 'Customer %d' % i, 'email': 'customer%d@example.com' % i,
+        'state': ('CA', 'NY', 'TX', 'WA')[i % 4], 'zipcode': '%05d' % i,
+        'valid': True} for i in range(1, count + 1)])
+    db.session.execute('ANALYZE orders')
+
+def _plan_nodes(db, url_params):
+    # Plan the filters alone, the ordering and pagination would let the
+    # planner walk the primary key instead
+    task = OrderFilterTask(MultiDict(url_params))
+    statement, parameters = compile_query(task._apply_filters(Order.query))
+    # Only an index that cannot serve the filter loses to a disabled scan
+    db.session.execute('SET LOCAL enable_seqscan = off')
+    plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' +
+        statement, parameters).scalar()
+    nodes, pending = [], [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+@pytest.mark.parametrize('field, value', [
+    ('name', 'ustomer 12'),
+    ('email', 'customer12@'),
+    ('zipcode', '0012'),
+])
+def test_partial_match_uses_the_trigram_index(postgres, field, value):
+    _seed(postgres)
+    index_names = [node.get('Index Name') for node in
+        _plan_nodes(postgres, {field + '_contains': value})]
+    assert 'ix_orders_%s_trgm' % field in index_names
+
+@pytest.mark.parametrize('field, value', [
+    ('name', 'customer 12'),
+    ('email', 'customer12@example.com'),
+    ('state', 'ny'),
+    ('zipcode', '00012'),
+])
+def test_exact_match_does_not_scan_the_table(postgres, field, value):
+    _seed(postgres)
+    node_types = [node['Node Type'] for node in
+        _plan_nodes(postgres, {field + '_equals': value})]
+    assert 'Seq Scan' not in node_types
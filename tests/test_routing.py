@@ -0,0 +1,71 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy.engine.url import make_url
+
+from acmewines import app, db
+from acmewines.cache import order_index, order_list_cache
+from acmewines.models import Order
+from acmewines.tasks import OrderFilterTask
+
+from conftest import make_record
+
+
+@pytest.fixture
+def broken_replica(database, tmpdir, monkeypatch):
+    # A replica without the orders table fails every order query
+    router = db.router
+    monkeypatch.setattr(router, '_uris',
+        ['sqlite:///' + str(tmpdir.join('replica.db'))])
+    monkeypatch.setattr(router, '_healthy', [True])
+    monkeypatch.setattr(router, '_engines', None)
+    monkeypatch.setattr(router, 'health_check_seconds', 3600)
+    yield router
+    db.session.remove()
+    router.dispose()
+
+def test_failed_replica_read_falls_back_to_the_primary(broken_replica,
+    monkeypatch):
+    Order.save_many([make_record(1), make_record(2)])
+    # Read past the stickiness of the write
+    broken_replica._local.last_write_at = 0
+    marked_down = []
+    monkeypatch.setattr(broken_replica, 'mark_down', marked_down.append)
+    orders = OrderFilterTask().run(as_dicts=True)
+    assert [order['id'] for order in orders] == [1, 2]
+    assert len(marked_down) == 1
+
+def test_sqlite_engines_skip_the_queue_pool_options(tmpdir):
+    options = {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 10,
+        'pool_recycle': 1800}
+    db.apply_driver_hacks(app, make_url('sqlite:///' +
+        str(tmpdir.join('orders.db'))), options)
+    assert sorted(options) == ['pool_recycle', 'poolclass']
+    sqlalchemy.create_engine('sqlite://', **options).dispose()
+
+def test_order_lookups_read_from_the_replicas(broken_replica, client,
+    monkeypatch):
+    Order.save_many([make_record(1)])
+    broken_replica._local.last_write_at = 0
+    marked_down = []
+    monkeypatch.setattr(broken_replica, 'mark_down', marked_down.append)
+    assert client.get('/orders/').status_code == 200
+    assert marked_down
+    del marked_down[:]
+    assert client.get('/orders/1').status_code == 200
+    assert marked_down
+
+def test_replica_reads_are_only_cached_past_the_lag(broken_replica, client,
+    monkeypatch):
+    Order.save_many([make_record(1)])
+    broken_replica._local.last_write_at = 0
+    monkeypatch.setattr(broken_replica, 'mark_down', lambda engine: None)
+    client.get('/orders/')
+    client.get('/orders/1')
+    assert order_list_cache.stats()['entries'] == 0
+    assert order_index.get(1) is None
+    monkeypatch.setattr(broken_replica, 'sticky_seconds', 0)
+    client.get('/orders/')
+    client.get('/orders/1')
+    assert order_list_cache.stats()['entries'] == 1
+    assert order_index.get(1) is not None
@@ -0,0 +1,53 @@
+import pytest
+
+from flask import json
+
+from acmewines.serializers import (ColumnarJSONSerializer, JSONSerializer,
+    MessagePackSerializer, msgpack)
+
+from conftest import make_record
+
+COLUMNAR_MIMETYPE = ColumnarJSONSerializer.mimetype
+
+
+def _import(client, records):
+    response = client.post('/orders/bulk', data=json.dumps(records),
+        content_type='application/json')
+    assert response.status_code == 200
+
+def test_json_serializer_splices_the_encoded_results():
+    serializer = JSONSerializer()
+    body = serializer.dumps_encoded({'num_of_orders': 2},
+        [serializer.dumps({'id': 1}), serializer.dumps({'id': 2})])
+    assert json.loads(body) == {'num_of_orders': 2,
+        'results': [{'id': 1}, {'id': 2}]}
+    assert json.loads(serializer.dumps_encoded({}, [])) == {'results': []}
+
+@pytest.mark.skipif(msgpack is None, reason='msgpack is not installed')
+def test_msgpack_serializer_matches_the_json_payload():
+    payload = {'num_of_orders': 1, 'results': [{'id': 1, 'name': u'Zo\xe9'}]}
+    body = MessagePackSerializer().recode(JSONSerializer().dumps(payload))
+    assert msgpack.unpackb(body, raw=False) == payload
+
+def test_order_list_is_negotiated(client):
+    _import(client, [make_record(1), make_record(2)])
+    response = client.get('/orders/', headers={'Accept': COLUMNAR_MIMETYPE})
+    assert response.mimetype == COLUMNAR_MIMETYPE
+    assert 'Accept' in response.headers['Vary']
+    assert json.loads(response.get_data())['results']['id'] == [1, 2]
+
+def test_columnar_batch_lists_the_missing_orders_apart(client):
+    _import(client, [make_record(1), make_record(3)])
+    response = client.get('/orders/batch?ids=1,2,3',
+        headers={'Accept': COLUMNAR_MIMETYPE})
+    payload = json.loads(response.get_data())
+    assert payload['num_of_orders'] == 2
+    assert payload['results']['id'] == [1, 3]
+    assert payload['not_found'] == ['The order of id=2 does not exist']
+
+def test_not_modified_response_varies_on_accept(client):
+    _import(client, [make_record(1)])
+    etag = client.get('/orders/1').headers['ETag']
+    response = client.get('/orders/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert 'Accept' in response.headers['Vary']
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from flask import json
+
+from acmewines import app
+from acmewines.tasks import (ExplainLimiter, MemoryJobStore, SQLiteJobStore,
+    normalize_statement)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmpdir.join('jobs.db')))
+
+def test_job_store_expires_the_jobs_done(store, monkeypatch):
+    for job_id in ('finished', 'failed', 'running'):
+        store.create(job_id, 'Task')
+        store.update(job_id, status=job_id)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    store.create('recent', 'Task')
+    store.update('recent', status='finished')
+    store.expire(60)
+    assert store.get('finished') is None and store.get('failed') is None
+    assert store.get('running')['status'] == 'running'
+    assert store.get('recent')['status'] == 'finished'
+
+def test_normalize_statement_collapses_the_placeholder_lists():
+    assert normalize_statement('SELECT * FROM orders\n WHERE id IN ' +
+        '(%(id_1)s, %(id_2)s) LIMIT %(param_1)s') ==\
+        normalize_statement('SELECT * FROM orders WHERE id IN (?, ?, ?) ' +
+        'LIMIT ?') == 'SELECT * FROM orders WHERE id IN (?) LIMIT ?'
+
+def test_explain_limiter_skips_the_statements_explained_recently():
+    limiter = ExplainLimiter(cooldown=60, max_in_flight=5)
+    assert limiter.acquire('SELECT * FROM orders WHERE id IN (?, ?)')
+    limiter.release()
+    assert not limiter.acquire('SELECT * FROM orders WHERE id IN (?)')
+    assert limiter.acquire('SELECT * FROM orders WHERE name = ?')
+
+def test_explain_limiter_caps_the_captures_in_flight():
+    limiter = ExplainLimiter(cooldown=60, max_in_flight=1)
+    assert limiter.acquire('SELECT 1')
+    assert not limiter.acquire('SELECT 2')
+    limiter.release()
+    assert limiter.acquire('SELECT 3')
+
+def test_orders_past_the_max_offset_are_refused(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ORDERS_MAX_OFFSET', 100)
+    assert client.get('/orders/?offset=100').status_code == 200
+    response = client.get('/orders/?offset=101')
+    assert response.status_code == 400
+    assert 'cursor' in json.loads(response.get_data())['bad_request']
@@ -0,0 +1,56 @@
+import pytest
+
+from acmewines.models import Order
+from acmewines.configs import validation
+from acmewines.validators import BatchOrderValidator, RulesetLoader
+
+from conftest import make_record
+
+records = [
+    make_record(1),
+    make_record(2, state='nj'),
+    make_record(3, state='XX', zipcode='1234'),
+    make_record(4, zipcode='99999-9999'),
+    make_record(5, email='not an email'),
+    make_record(6, birthday='1980-01-01'),
+    make_record(7, birthday='Jan 01, 2015'),
+    make_record(8, name=None, zipcode=None),
+]
+
+def _validate_with_setters(record):
+    order = Order(**record)
+    order._update_validation_failure(order._validate_missing_fields())
+    return order.valid, order.validation_failure
+
+@pytest.mark.parametrize('record', records, ids=lambda record: record['id'])
+def test_batch_validator_matches_the_setters(record):
+    columns = dict((field_name, [record[field_name]])
+        for field_name in record)
+    validated = BatchOrderValidator().validate(columns)
+    assert (validated['valid'][0], validated['validation_failure'][0]) ==\
+        _validate_with_setters(record)
+
+def _write_rules(path, **overrides):
+    with open(validation.__file__.replace('.pyc', '.py')) as f:
+        source = f.read()
+    for name, value in overrides.items():
+        source += '\n%s = %r\n' % (name, value)
+    path.write(source)
+
+def test_ruleset_loader_picks_up_changed_rules(tmpdir):
+    path = tmpdir.join('validation.py')
+    _write_rules(path)
+    loader = RulesetLoader(str(path), reload_seconds=None)
+    assert loader.get().check_state('NJ') is not None
+    _write_rules(path, states_not_allowed=[])
+    ruleset = loader.reload()
+    assert ruleset.check_state('NJ') is None
+    assert loader.get() is ruleset
+
+def test_ruleset_loader_keeps_the_rules_when_the_file_breaks(tmpdir):
+    path = tmpdir.join('validation.py')
+    _write_rules(path)
+    loader = RulesetLoader(str(path), reload_seconds=None)
+    ruleset = loader.get()
+    path.write('states = [')
+    assert loader.reload() is ruleset